@@ -0,0 +1,122 @@
+# bytes per frame of the snow.py and bounce.py animations drawn into a
+# shared FrameBuffer, sending damage as before (collapsed to a bounding
+# rectangle when too many regions are damaged, otherwise sent as damaged)
+# and optimised by the estimated cost of each encoding (rfb.damage)
+import rfb
+
+try:
+    # cpython, repeatable
+    from random import getrandbits, seed
+    seed(1)
+except:
+    # micropython unix port
+    from urandom import getrandbits, seed
+    seed(1)
+
+def rand():
+    return getrandbits(8)
+
+w, h = 255, 255
+frames = 30
+
+
+class Viewer(rfb.RfbSession):
+
+    # a session without a connection, counting what would be sent
+    def __init__(self, encodings, optimise):
+        self.setup(w, h, b'benchmark')
+        self.encodings = encodings
+        self.optimise_damage = optimise
+        self.damage.optimised = optimise
+        self.sent = 0
+        self.rects = 0
+
+    def send(self, b):
+        if b:
+            self.sent += sum( len(buffer) for buffer in b )
+            self.rects += (b[0][2]<<8) + b[0][3]
+
+
+class Snow():
+
+    # as snow.py, each flake is a black strip above a white square
+    def __init__(self, fb):
+        self.fb = fb
+        self.flakes = []
+
+    def update(self):
+        # [x, y, size, vector]
+        self.flakes = [ f for f in self.flakes if f[1]+f[2]+f[3] < 255 ]
+        for flake in self.flakes:
+            flake[1] += flake[3]
+        for i in range( rand()>>2 ):
+            x = rand()
+            size = rand()>>6
+            x = x if x<w-size else x-size
+            self.flakes.append( [x, 0, size, 3-size] )
+        for x, y, size, vector in self.flakes:
+            self.fb.fill_rect(x, y, size, vector, (0,0,0))
+            self.fb.fill_rect(x, y+vector, size, size, (255,255,255))
+
+
+class Bounce():
+
+    # as bounce.py, a square with an inner square bouncing within it,
+    # the previous position cleared (as shared.py) not the whole frame
+    def __init__(self, fb):
+        self.fb = fb
+        self.large = [w//2-25, h//2-25, 50, [rand()//60, rand()//60]]
+        self.small = [25, 25, 20, [rand()//60, rand()//60]]
+
+    def move(self, r, parent):
+        x, y, size, vector = r
+        if x+vector[0] <= 0 or x+size+vector[0] >= parent:
+            vector[0] = -vector[0]
+        if y+vector[1] <= 0 or y+size+vector[1] >= parent:
+            vector[1] = -vector[1]
+        r[0] += vector[0]
+        r[1] += vector[1]
+
+    def update(self):
+        large, small = self.large, self.small
+        self.fb.fill_rect(large[0], large[1], 50, 50, (0,0,0))
+        self.move(small, 50)
+        self.move(large, w)
+        self.fb.fill_rect(large[0], large[1], 50, 50, (255,255,255))
+        self.fb.fill_rect(large[0]+small[0], large[1]+small[1], 20, 20,
+                          (0,0,0))
+
+
+# return (bytes, rectangles) per frame
+def run(scene, encodings, optimise):
+    seed(1)
+    fb = rfb.FrameBuffer(w, h)
+    fb.damaged.optimised = optimise
+    viewer = Viewer(encodings, optimise)
+    fb.attach(viewer)
+    animation = scene(fb)
+    # initial full frame is not counted
+    fb.commit()
+    viewer.send_damage()
+    viewer.sent = viewer.rects = 0
+    for i in range(frames):
+        animation.update()
+        fb.commit()
+        viewer.send_damage()
+    return viewer.sent//frames, viewer.rects//frames
+
+
+encodings = [('raw', rfb.RAWRECT), ('rre', rfb.RRERECT),
+             ('corre', rfb.CORRE), ('hextile', rfb.HEXTILE)]
+if rfb.zlib:
+    encodings.append( ('zrle', rfb.ZRLE) )
+
+print('bytes (rectangles) per frame, before and after optimisation')
+for scene in (Snow, Bounce):
+    for name, encoding in encodings:
+        before = run(scene, [encoding], False)
+        after = run(scene, [encoding], True)
+        print('%-6s %-7s %7d (%3d) %7d (%3d)' % (
+                  scene.__name__, name, before[0], before[1],
+                  after[0], after[1]
+             ))
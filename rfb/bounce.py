@@ -30,6 +30,14 @@ def update(self, parent_w, parent_h):
     self.y += self.vector[1]
 
 
+# rectangles have no __dict__, attributes must be declared
+class Square(rfb.RRERect):
+    __slots__ = ('vector',)
+
+class InnerSquare(rfb.RRESubRect):
+    __slots__ = ('vector',)
+
+
 class Bounce(rfb.RfbSession):
 
     def __init__(self, conn, w, h, name):
@@ -46,7 +54,7 @@ class Bounce(rfb.RfbSession):
                 )
         ]
         
-        self.large = rfb.RRERect( # large bouncing square
+        self.large = Square( # large bouncing square
                                  w//2-25, h//2-25,
                                  50, 50,
                                  (255, 255, 255),
@@ -56,9 +64,8 @@ class Bounce(rfb.RfbSession):
                                 )
         # vector must be mutable
         self.large.vector = [rand()//60, rand()//60]
-        self.large.update = update
 
-        self.small = rfb.RRESubRect( # inner square
+        self.small = InnerSquare( # inner square
                                     self.large.w//2, self.large.h//2,
                                     20, 20,
                                     (0,0,0),
@@ -68,15 +75,14 @@ class Bounce(rfb.RfbSession):
                                    )
         # vector must be mutable
         self.small.vector = [rand()//60, rand()//60]
-        self.small.update = update
 
         self.large.subrectangles.append( self.small )
         self.rectangles.append( self.large )
 
     def update(self):
         self.send( rfb.ServerFrameBufferUpdate( self.rectangles ) )
-        self.small.update(self.small, self.large.w, self.large.h)
-        self.large.update(self.large, w, h)
+        update(self.small, self.large.w, self.large.h)
+        update(self.large, w, h)
 
 
 svr = rfb.RfbServer(w, h, name=b'bounce', handler=Bounce)
@@ -5,6 +5,19 @@ except:
 from rfb.session import *
 from rfb.servermsgs import *
 from rfb.encodings import *
+from rfb.framebuffer import FrameBuffer
+from rfb.pixelformat import PixelFormat, Palette
+
+try: # asyncio flavour, optional
+    from rfb.aio import AsyncRfbServer, AsyncRfbSession
+except:
+    pass
+
+try: # not available in micropython, serve() polls instead
+    import selectors
+    from time import monotonic
+except:
+    selectors = None
 
 try: # mpy/cpython compat in main loop
     BlockingIOError
@@ -25,6 +38,8 @@ class RfbServer():
                  handler = RfbSession,
                  addr = ('0.0.0.0', 5900), #mpy doesn't like b'' 
                  backlog = 3, # no. concurrent connections serviced
+                 framebuffer = False, # share a server framebuffer
+                 tick_ms = 20, # update() interval of the selector loop
                 ):
         self.w = w
         self.h = h
@@ -34,42 +49,176 @@ class RfbServer():
         self.name = name if type(name) is bytes else bytes(name,'utf-8')
         self.handler = handler
         self.sessions = []
+        # connections yet to complete the session handshake
+        self.handshakes = []
+        # one canvas drawn by the application, damage is tracked
+        # and sent per session
+        self.framebuffer = FrameBuffer(w, h) if framebuffer else None
+        self.tick_ms = tick_ms
+        # set while serve() runs a selector loop
+        self.selector = None
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.s.setblocking(False) # unix mpy has no .settimeout(0)?
         self.s.bind( socket.getaddrinfo(addr[0],addr[1])[0][-1] ) # req'd by mpy
         self.s.listen(backlog)
 
+    # client connections are closed when serving ends
     def serve(self):
-        while True:
-            #accept new connections
-            self.accept()
-            # handle established connections
-            self.service()
+        try:
+            if selectors is not None:
+                return self.serve_selector()
+            while True:
+                #accept new connections
+                self.accept()
+                # handle established connections
+                self.service()
+        finally:
+            self.shutdown()
+
+    # sleep until the listening socket or a session socket is readable,
+    # or the next tick is due; sessions are only read when readable and
+    # updated once per tick, so an idle server does not spin
+    def serve_selector(self):
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.s, selectors.EVENT_READ)
+        for session in self.handshakes + self.sessions:
+            self.register(session)
+        tick = self.tick_ms/1000
+        due = monotonic()
+        try:
+            while True:
+                for key, events in self.selector.select(
+                                       max(0, due-monotonic()) ):
+                    if key.fileobj is self.s:
+                        self.accept()
+                    elif isinstance(key.data, RfbHandshake):
+                        self.service_handshake(key.data)
+                    else:
+                        self.service_session(key.data)
+                now = monotonic()
+                if now >= due:
+                    # don't try to catch up on missed ticks
+                    due = max(due+tick, now)
+                    self.update_sessions()
+        finally:
+            self.selector.close()
+            self.selector = None
+
+    def register(self, session):
+        # socket is known readable, no need for recv() to wait
+        session.recv_delay = 0
+        self.selector.register(session.conn, selectors.EVENT_READ, session)
     
+    # the handshake of new connections is advanced by service(), the
+    # handler is created once complete
     def accept(self):
         try:
-            self.sessions.append( 
-                self.handler(
-                    self.s.accept(),
-                    self.w, self.h,
-                    self.name
-                )
-            )
+            conn = self.s.accept()
         except (OSError, BlockingIOError): # mpy, cpython 
-            pass
+            return
+        try:
+            handshake = RfbHandshake(conn, self.w, self.h, self.name)
+        except (OSError, ConnectionAbortedError, ConnectionResetError):
+            conn[0].close()
+            return
+        self.handshakes.append(handshake)
+        if self.selector is not None:
+            self.register(handshake)
+
+    def service_handshake(self, handshake):
+        try:
+            if not handshake.advance():
+                return
+            session = self.handler(handshake, self.w, self.h, self.name)
+        except (RfbSessionRejected, 
+                OSError, ConnectionAbortedError, ConnectionResetError):
+            self.drop(handshake)
+            return
+        self.handshakes.remove(handshake)
+        if self.framebuffer is not None:
+            self.framebuffer.attach(session)
+        self.sessions.append(session)
+        if self.selector is not None:
+            self.selector.unregister(handshake.conn)
+            self.register(session)
+
+    # called once per loop before sessions are serviced, over-ride
+    # in a sub-class to draw into self.framebuffer
+    def update(self):
+        pass
 
     def service(self):
-        for idx,session in enumerate( self.sessions ):
+        for handshake in self.handshakes[:]:
+            self.service_handshake(handshake)
+        # iterate over a copy, dead sessions are removed
+        for session in self.sessions[:]:
+            self.service_session(session)
+        self.update_sessions()
+
+    # read and dispatch a session's client messages
+    def service_session(self, session):
+        try:
             alive = session.service_msg_queue()
-            if not alive:
-                del( self.sessions[idx] )
-            else:
-                try:
+        # session teardown
+        except (OSError, ConnectionAbortedError, ConnectionResetError):
+            alive = False
+        if not alive:
+            self.close(session)
+
+    # remove a handshake, closing its connection
+    def drop(self, handshake):
+        if handshake in self.handshakes:
+            self.handshakes.remove(handshake)
+        if self.selector is not None:
+            try:
+                self.selector.unregister(handshake.conn)
+            except (KeyError, ValueError):
+                pass
+        try:
+            handshake.conn.close()
+        except OSError:
+            pass
+
+    # update the server and its framebuffer, then each session;
+    # handshakes that have stalled are dropped
+    def update_sessions(self):
+        for handshake in self.handshakes[:]:
+            if handshake.expired():
+                self.drop(handshake)
+        self.update()
+        if self.framebuffer is not None:
+            self.framebuffer.commit()
+        for session in self.sessions[:]:
+            # errors in update() propagate, sessions all have update()
+            try:
+                session.service_input()
+                # frames are skipped while the client is behind
+                if session.ready():
                     session.update()
-                # session has no update() method
-                except AttributeError:
-                    pass
-                # session teardown
-                except (OSError, ConnectionAbortedError, ConnectionResetError):
-                    del( self.sessions[idx] )
+            # session teardown
+            except (OSError, ConnectionAbortedError, ConnectionResetError):
+                self.close(session)
+
+    def close(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+        if self.selector is not None:
+            try:
+                self.selector.unregister(session.conn)
+            except (KeyError, ValueError): # not registered, or closed
+                pass
+        if self.framebuffer is not None:
+            self.framebuffer.detach(session)
+        try:
+            session.conn.close()
+        except OSError:
+            pass
+
+    # close all client connections, and those yet to complete the
+    # handshake
+    def shutdown(self):
+        for session in self.sessions[:]:
+            self.close(session)
+        for handshake in self.handshakes[:]:
+            self.drop(handshake)
 
@@ -0,0 +1,248 @@
+try:
+    import uasyncio as asyncio
+except:
+    import asyncio
+
+try:
+    from ustruct import pack
+except:
+    from struct import pack
+
+from rfb.session import RfbSession, RfbSessionRejected, encodings_known
+from rfb.framebuffer import FrameBuffer
+
+
+# RfbSession driven by asyncio streams, client messages are dispatched
+# to the same Client... callbacks, and update() is called on the ticks
+# the server wakes the session (refer due())
+class AsyncRfbSession(RfbSession):
+
+    # ms waiting for the client during the handshake before it is
+    # rejected (as RfbHandshake)
+    timeout_ms = 10000
+
+    def __init__(self, reader, writer, w, h, name):
+        self.reader = reader
+        self.writer = writer
+        self.conn = writer
+        self.addr = writer.get_extra_info('peername')
+        self.setup(w, h, name)
+        # set by the server on ticks the session is due an update
+        self.wake = asyncio.Event()
+
+    async def handshake(self):
+        # HandShake
+        self.send( b'RFB 003.003\n' )
+        if await self.wait(self.reader.readexactly(12)) != b'RFB 003.003\n':
+            raise RfbSessionRejected('version proposal')
+
+        # Security
+        self.send( pack('>L', self.security) )
+        # ignore instruction to disconnect other clients
+        if (await self.wait(self.reader.readexactly(1)))[0] not in (0,1):
+            raise RfbSessionRejected('no security')
+
+        # ServerInit
+        self.send( self.server_init() )
+        await self.writer.drain()
+
+        # as RfbHandshake, messages are read until the client's
+        # encodings are known, so the first update is in its encoding
+        b = b''
+        while not encodings_known(b):
+            msg = await self.wait(self.reader.read(self.recv_buffer_size))
+            if not msg:
+                return False
+            b += msg
+        self.buffer_msgs(b)
+        if not self.dispatch():
+            raise RfbSessionRejected('client message')
+        await self.writer.drain()
+        return True
+
+    # await a read of the client during the handshake, rejecting a
+    # client that has stalled (refer timeout_ms)
+    async def wait(self, read):
+        try:
+            return await asyncio.wait_for(read, self.timeout_ms/1000)
+        except asyncio.TimeoutError:
+            raise RfbSessionRejected('timed out')
+
+    # buffered, written by the event loop; sessions wait for the
+    # client to catch up in serve() and updates()
+    def send(self, b):
+        if not b:
+            return
+        if type(b) is list:
+            self.writer.writelines(b)
+        else:
+            self.writer.write(b)
+
+    # read and dispatch client messages, False when closed by peer or
+    # a message is unknown or too long
+    async def read_msgs(self):
+        msg = await self.reader.read(self.recv_buffer_size)
+        if not msg:
+            return False
+        self.buffer_msgs(msg)
+        if not self.dispatch():
+            return False
+        await self.writer.drain()
+        return True
+
+    # True if the session has something to send on this tick: sessions
+    # over-riding update() are due every tick, others only with damage,
+    # moves, the cursor or a palette to send, or input to deliver, so
+    # idle sessions cost nothing between ticks
+    def due(self):
+        if type(self).update is not AsyncRfbSession.update:
+            return True
+        return bool(self.damage or self.moves or self.input_queue) \
+               or self.cursor_pending() \
+               or not self.true and self.colourmap is not self.pixelformat.palette
+
+    # update each time woken by the server
+    async def updates(self):
+        try:
+            while True:
+                await self.wake.wait()
+                self.wake.clear()
+                self.service_input()
+                if self.ready():
+                    self.update()
+                await self.writer.drain()
+        finally:
+            # ends read_msgs() in serve()
+            self.writer.close()
+
+    # serve the session until closed by either peer
+    async def serve(self):
+        updates = asyncio.ensure_future(self.updates())
+        try:
+            while await self.read_msgs() and not updates.done():
+                pass
+        finally:
+            updates.cancel()
+        # raise any exception from update()
+        if updates.done() and not updates.cancelled():
+            updates.result()
+
+
+class AsyncRfbServer():
+
+    # as RfbServer, handler must be an AsyncRfbSession (sub-class)
+    def __init__(self,
+                 w, h,
+                 name = b'rfb',
+                 handler = AsyncRfbSession,
+                 addr = ('0.0.0.0', 5900),
+                 backlog = 100,
+                 framebuffer = False, # share a server framebuffer
+                 tick_ms = 20, # update() interval
+                ):
+        self.w = w
+        self.h = h
+        # rfb session init fails with 0 length name
+        if len(name) < 1:
+            raise ValueError('name cannot be empty')
+        self.name = name if type(name) is bytes else bytes(name,'utf-8')
+        self.handler = handler
+        self.addr = addr
+        self.backlog = backlog
+        self.sessions = []
+        self.framebuffer = FrameBuffer(w, h) if framebuffer else None
+        self.tick_ms = tick_ms
+        self.server = None
+        self._updates = None
+        # accept() tasks, of sessions and handshakes in progress, and
+        # their writers
+        self._tasks = []
+        self._writers = []
+
+    # start listening, and updating the framebuffer, then return
+    async def start(self):
+        self.server = await asyncio.start_server(
+                          self.accept,
+                          self.addr[0], self.addr[1],
+                          backlog = self.backlog
+                      )
+        self._updates = asyncio.ensure_future(self.updates())
+        return self.server
+
+    # serve until cancelled
+    async def serve(self):
+        await self.start()
+        try:
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            await self.shutdown()
+
+    # ms shutdown() waits for connections to end, once closed, before
+    # cancelling their tasks
+    shutdown_ms = 1000
+
+    # stop listening and updating, close all client connections
+    # (including those yet to complete the handshake) and wait for
+    # their tasks to end
+    async def shutdown(self):
+        if self._updates is not None:
+            self._updates.cancel()
+        if self.server is not None:
+            self.server.close()
+        # closed, reads end and so do the tasks
+        for writer in self._writers[:]:
+            writer.close()
+        tasks = self._tasks[:]
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*tasks, return_exceptions=True),
+                self.shutdown_ms/1000
+            )
+        except asyncio.TimeoutError: # cancelled, tasks still running
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+
+    # called for each new connection by the asyncio server
+    async def accept(self, reader, writer):
+        session = self.handler(reader, writer, self.w, self.h, self.name)
+        task = asyncio.current_task()
+        self._tasks.append(task)
+        self._writers.append(writer)
+        try:
+            if await session.handshake():
+                if self.framebuffer is not None:
+                    self.framebuffer.attach(session)
+                self.sessions.append(session)
+                await session.serve()
+        # session teardown
+        except (RfbSessionRejected, OSError, EOFError):
+            pass
+        finally:
+            self._tasks.remove(task)
+            self._writers.remove(writer)
+            self.close(session)
+            writer.close()
+
+    # called once per tick, before sessions are updated, over-ride
+    # in a sub-class to draw into self.framebuffer
+    def update(self):
+        pass
+
+    # the one tick of the server, waking sessions due an update
+    async def updates(self):
+        while True:
+            self.update()
+            if self.framebuffer is not None:
+                self.framebuffer.commit()
+            for session in self.sessions:
+                if session.due():
+                    session.wake.set()
+            await asyncio.sleep(self.tick_ms/1000)
+
+    def close(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+        if self.framebuffer is not None:
+            self.framebuffer.detach(session)
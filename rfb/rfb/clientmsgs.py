@@ -1,30 +1,70 @@
-# TODO: consider using u/struct
-from rfb.utils import bytes_to_int
+try:
+    from ustruct import unpack_from
+except:
+    from struct import unpack_from
 
+# lengths of client messages of fixed length, by message type
+# (150 EnableContinuousUpdates, 250 xvp)
+lengths = {0: 20, 3: 10, 4: 8, 5: 6, 150: 10, 250: 4}
+
+# return the length of the message at msg[ptr], 0 if too little of the
+# message has been received to tell, or None if the type is unknown
+def msg_length(msg, ptr):
+    available = len(msg) - ptr
+    l = lengths.get(msg[ptr])
+    if l is not None:
+        return l
+    # ClientSetEncodings, count of 4 byte encodings
+    if msg[ptr] == 2:
+        if available < 4:
+            return 0
+        return 4 + unpack_from('>H', msg, ptr+2)[0]*4
+    # ClientCutText, length of text
+    if msg[ptr] == 6:
+        if available < 8:
+            return 0
+        return 8 + unpack_from('>L', msg, ptr+4)[0]
+    # ClientFence, length of payload
+    if msg[ptr] == 248:
+        if available < 9:
+            return 0
+        return 9 + msg[ptr+8]
+    # SetDesktopSize, count of 16 byte screens
+    if msg[ptr] == 251:
+        if available < 8:
+            return 0
+        return 8 + msg[ptr+6]*16
+
+# dispatch each complete message in msg (bytes-like), return the number
+# of bytes used; any incomplete message following is left for the caller
+# to dispatch once the rest of it has been received; None if a message
+# is of unknown type, or longer than self.recv_buffer_max, as what
+# follows can't be parsed (or held)
 def dispatch_msgs(self, msg):
 
     # handle multiple messages
     ptr = 0
     while ptr < len(msg):
 
+        l = msg_length(msg, ptr)
+        if l and l > self.recv_buffer_max:
+            return None
+        if l == 0 or (l and ptr+l > len(msg)):
+            # incomplete
+            return ptr
+
         # ClientSetPixelFormat(self, bpp, depth, big, true, masks, shifts)
         if msg[ptr] == 0:
             # if ClientSetPixelFormat is received, post init
             # over-rules ServerSetPixelFormat sent, during init
-            self.bpp = msg[ptr+4]
-            self.depth = msg[ptr+5]
-            self.big = msg[ptr+6] == 1
-            self.true = msg[ptr+7] == 1
-            self.masks = (
-                bytes_to_int( msg[ptr+8:ptr+10] ),
-                bytes_to_int( msg[ptr+10:ptr+12] ),
-                bytes_to_int( msg[ptr+12:ptr+14] ),
-            )
-            self.shifts = (
-                msg[ptr+14],
-                msg[ptr+15],
-                msg[ptr+16]
-            ) 
+            bpp, depth, big, true, rmax, gmax, bmax, rs, gs, bs = \
+                unpack_from('>4x4B3H3B', msg, ptr)
+            self.bpp = bpp
+            self.depth = depth
+            self.big = big == 1
+            self.true = true == 1
+            self.masks = (rmax, gmax, bmax)
+            self.shifts = (rs, gs, bs)
             if hasattr(self, 'ClientSetPixelFormat'):
                 self.ClientSetPixelFormat(
                     self.bpp,
@@ -34,71 +74,124 @@ def dispatch_msgs(self, msg):
                     self.masks,
                     self.shifts                    
                 )
-            # Colourmap (not currently implemented):
-            #   If this msg is recv'd from client svr colourmap sent during 
-            #   init is cleared, therefore svr must send again before sending
-            #   any framebuffer updates
-            ptr += 20 # includes trailing padding
+            # the client's colour map is cleared, a colour map must be
+            # sent again before any framebuffer updates
+            self.colourmap = None
+            # pixels the client has are of the previous format
+            if self.framebuffer is not None:
+                self.damage.add(0, 0, self.w, self.h)
 
         # ClientSetEncodings(self, encodings)
         elif msg[ptr] == 2:
-            count = bytes_to_int( msg[ptr+2:ptr+4] )
-            encodings = [
-                bytes_to_int( msg[ptr+4+i : ptr+8+i] )
-                for i in range(0, count*4, 4)
-            ]
+            # signed, pseudo-encodings are -ve
+            encodings = list(
+                unpack_from('>%di' % ((l-4)//4), msg, ptr+4)
+            )
             # session encodings are sent/set by client post init
             self.encodings = encodings
             if hasattr(self, 'ClientSetEncodings'):
                 self.ClientSetEncodings(encodings)
-            ptr += 4 + (count*4)
 
         # ClientFrameBufferUpdateRequest(self, incr, x, y, w, h)
         elif msg[ptr] == 3:
             if hasattr(self, 'ClientFrameBufferUpdateRequest'):
-                self.ClientFrameBufferUpdateRequest(
-                    msg[ptr+1] == 1,
-                    bytes_to_int( msg[ptr+2:ptr+4] ),
-                    bytes_to_int( msg[ptr+4:ptr+6] ),
-                    bytes_to_int( msg[ptr+6:ptr+8] ),
-                    bytes_to_int( msg[ptr+8:ptr+10] )
-                )
-            ptr += 10
+                incr, x, y, w, h = unpack_from('>xB4H', msg, ptr)
+                self.ClientFrameBufferUpdateRequest(incr == 1, x, y, w, h)
 
         # ClientKeyEvent(self, down, key)
         elif msg[ptr] == 4:
             if hasattr(self, 'ClientKeyEvent'):
-                self.ClientKeyEvent(
-                    msg[ptr+1] == 1,
-                    bytes_to_int( msg[ptr+4:ptr+8] )
-                )
-            ptr += 8
+                down, key = unpack_from('>xB2xL', msg, ptr)
+                if getattr(self, 'input_queue', None) is not None:
+                    self.input_queue.key(down == 1, key)
+                else:
+                    self.ClientKeyEvent(down == 1, key)
 
         # ClientPointerEvent(self, buttons, x, y)
         elif msg[ptr] == 5:
             if hasattr(self, 'ClientPointerEvent'):
-                self.ClientPointerEvent(
-                    msg[ptr+1],
-                    bytes_to_int( msg[ptr+2:ptr+4] ),
-                    bytes_to_int( msg[ptr+4:ptr+6] )
-                )
-            ptr += 6
+                buttons, x, y = unpack_from('>xB2H', msg, ptr)
+                if getattr(self, 'input_queue', None) is not None:
+                    self.input_queue.pointer(buttons, x, y)
+                else:
+                    self.ClientPointerEvent(buttons, x, y)
 
         # ClientCutText(self, text)
         elif msg[ptr] == 6:
-            l = bytes_to_int( msg[2:6] )
             if hasattr(self, 'ClientCutText'):
                 self.ClientCutText(
-                    msg[ptr+6 : ptr+l]
+                    bytes( msg[ptr+8 : ptr+l] )
                 )
-            ptr += 6 + l
 
-        elif msg[ptr] > 6:
-            if hasattr(self, 'ClientOtherMsg'):
-                # ClientOtherMsg must return len of 1st msg
-                ptr += ClientOtherMsg(msg)
-            else:
-                # skip all messages
-                # ... no way to tell how long the msg is ... 
-                ptr = len(msg)
+        # ClientEnableContinuousUpdates(self, enable, x, y, w, h)
+        elif msg[ptr] == 150 \
+             and hasattr(self, 'ClientEnableContinuousUpdates'):
+            enable, x, y, w, h = unpack_from('>xB4H', msg, ptr)
+            self.ClientEnableContinuousUpdates(enable == 1, x, y, w, h)
+
+        # ClientFence(self, flags, payload)
+        elif msg[ptr] == 248 and hasattr(self, 'ClientFence'):
+            flags = unpack_from('>4xL', msg, ptr)[0]
+            self.ClientFence(flags, bytes( msg[ptr+9 : ptr+l] ))
+
+        elif hasattr(self, 'ClientOtherMsg'):
+            # ClientOtherMsg must return len of 1st msg, or 0 if it
+            # is incomplete; msg is the 1st msg if its length is known
+            n = self.ClientOtherMsg(
+                    bytes( msg[ptr : ptr+l] if l else msg[ptr:] )
+                )
+            if l is None:
+                if not n:
+                    return ptr
+                l = n
+
+        if l is None:
+            # no way to tell how long the msg is, or where the next
+            # one starts
+            return None
+        ptr += l
+
+    return ptr
+
+
+# key and pointer events queued by dispatch_msgs, to be delivered as a
+# batch; pointer moves with an unchanged button mask are merged into the
+# latest position, button changes and key events are kept, in order
+class InputQueue():
+
+    KEY = 4
+    POINTER = 5
 
+    def __init__(self):
+        self.events = []
+        # button mask of the last pointer event
+        self.buttons = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def key(self, down, key):
+        self.events.append( (self.KEY, down, key) )
+
+    def pointer(self, buttons, x, y):
+        moved = buttons == self.buttons
+        self.buttons = buttons
+        if moved and self.events:
+            last = self.events[-1]
+            # replace a queued move, not a button change
+            if last[0] == self.POINTER and last[4]:
+                self.events[-1] = (self.POINTER, buttons, x, y, True)
+                return
+        self.events.append( (self.POINTER, buttons, x, y, moved) )
+
+    # call session's ClientKeyEvent and ClientPointerEvent with each
+    # event queued, return the number of events delivered
+    def deliver(self, session):
+        events = self.events
+        self.events = []
+        for event in events:
+            if event[0] == self.KEY:
+                session.ClientKeyEvent(event[1], event[2])
+            else:
+                session.ClientPointerEvent(event[1], event[2], event[3])
+        return len(events)
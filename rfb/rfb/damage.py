@@ -0,0 +1,200 @@
+# rectangles are (x, y, w, h) tuples in framebuffer co-ordinates
+
+def intersect(a, b):
+    x = max(a[0], b[0])
+    y = max(a[1], b[1])
+    x2 = min(a[0]+a[2], b[0]+b[2])
+    y2 = min(a[1]+a[3], b[1]+b[3])
+    if x2 > x and y2 > y:
+        return (x, y, x2-x, y2-y)
+    # else: None, rectangles don't overlap
+
+
+def contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] \
+           and a[0]+a[2] >= b[0]+b[2] \
+           and a[1]+a[3] >= b[1]+b[3]
+
+
+def bounds(rects):
+    x = min( r[0] for r in rects )
+    y = min( r[1] for r in rects )
+    x2 = max( r[0]+r[2] for r in rects )
+    y2 = max( r[1]+r[3] for r in rects )
+    return (x, y, x2-x, y2-y)
+
+
+def subtract(a, b):
+    # return list of (up to 4) rectangles covering a, less b
+    i = intersect(a, b)
+    if i is None:
+        return [a]
+    rects = []
+    if i[1] > a[1]: # above
+        rects.append( (a[0], a[1], a[2], i[1]-a[1]) )
+    if i[1]+i[3] < a[1]+a[3]: # below
+        rects.append( (a[0], i[1]+i[3], a[2], a[1]+a[3]-i[1]-i[3]) )
+    if i[0] > a[0]: # left
+        rects.append( (a[0], i[1], i[0]-a[0], i[3]) )
+    if i[0]+i[2] < a[0]+a[2]: # right
+        rects.append( (i[0]+i[2], i[1], a[0]+a[2]-i[0]-i[2], i[3]) )
+    return rects
+
+
+def area(r):
+    return r[2]*r[3]
+
+
+# return list of rectangles covering r, none wider or higher than size
+def split(r, size):
+    x, y, w, h = r
+    if w <= size and h <= size:
+        return [r]
+    return [ (tx, ty, min(size, x+w-tx), min(size, y+h-ty))
+             for ty in range(y, y+h, size)
+             for tx in range(x, x+w, size) ]
+
+
+# return rects (x, y, w, h) as a set cheaper to send, where each costs
+# rect_cost bytes plus pixel_cost bytes per pixel: rectangles are merged
+# into their bounding rectangle where the clean pixels added cost less
+# than the rectangle saved, then overlaps are split off where re-sending
+# them costs more than the extra rectangles; if limit is given, merges
+# are made at increasing cost until no more than limit remain
+def optimise(rects, rect_cost=16, pixel_cost=4, limit=None):
+    if len(rects) < 2:
+        return list(rects)
+    # clean pixels worth sending to save a rectangle
+    waste = rect_cost/pixel_cost
+    # sorted by x, a merge keeps the left-most x
+    rects = sorted(rects)
+    while merge(rects, waste) or (limit and len(rects) > limit):
+        if limit and len(rects) > limit:
+            waste = waste*2 + 1
+    parts = disjoint(rects, rect_cost/pixel_cost)
+    if limit and len(parts) > limit:
+        return rects
+    return parts
+
+# merge rects (sorted by x) where the bounding rectangle adds no more
+# than waste pixels, return True if any were merged
+def merge(rects, waste):
+    merged = False
+    i = 0
+    while i < len(rects):
+        ax, ay, aw, ah = rects[i]
+        j = i+1
+        # rects further right are more than waste pixels apart
+        while j < len(rects) and rects[j][0] <= ax+aw+waste:
+            bx, by, bw, bh = rects[j]
+            if by <= ay+ah+waste and ay <= by+bh+waste:
+                # bounding rectangle, bx >= ax
+                x2 = max(ax+aw, bx+bw)
+                y = min(ay, by)
+                y2 = max(ay+ah, by+bh)
+                # overlap is not added
+                ow = min(ax+aw, bx+bw) - bx
+                oh = min(ay+ah, by+bh) - max(ay, by)
+                overlap = ow*oh if ow > 0 and oh > 0 else 0
+                if (x2-ax)*(y2-y) - aw*ah - bw*bh + overlap <= waste:
+                    ay, aw, ah = y, x2-ax, y2-y
+                    rects[i] = (ax, ay, aw, ah)
+                    del rects[j]
+                    merged = True
+                    # may now reach rects already passed
+                    j = i+1
+                    continue
+            j += 1
+        i += 1
+    return merged
+
+
+# remove pixels covered more than once from rects (sorted by x), where
+# the rectangles added cost less than waste pixels per rectangle
+def disjoint(rects, waste):
+    out = []
+    # rects to the right of x
+    active = []
+    for r in rects:
+        active = [ o for o in active if o[0]+o[2] > r[0] ]
+        pieces = [r]
+        for o in active:
+            parts = []
+            for p in pieces:
+                i = intersect(p, o)
+                if i is None:
+                    parts.append(p)
+                    continue
+                less = subtract(p, o)
+                if area(i) > (len(less)-1)*waste:
+                    parts.extend(less)
+                else:
+                    parts.append(p)
+            pieces = parts
+        out.extend(pieces)
+        active.extend(pieces)
+    return out
+
+
+class Damage():
+
+    # if False more than limit regions are collapsed to a single bounding
+    # rectangle, rather than optimised (refer optimise())
+    optimised = True
+
+    # set of dirty regions, reduced to limit/2 regions, by the cost of
+    # sending them, when more than limit regions are held
+    def __init__(self, limit=32):
+        self.rects = []
+        self.limit = limit
+        # cost model (refer optimise()), set by sessions from the encoding
+        self.rect_cost = 16
+        self.pixel_cost = 4
+
+    def __len__(self):
+        return len(self.rects)
+
+    def add(self, x, y, w, h):
+        r = (x, y, w, h)
+        if w < 1 or h < 1:
+            return
+        for existing in self.rects:
+            if contains(existing, r):
+                return
+        self.rects = [ e for e in self.rects if not contains(r, e) ]
+        self.rects.append(r)
+        if len(self.rects) > self.limit:
+            if self.optimised:
+                self.rects = optimise(
+                                 self.rects,
+                                 self.rect_cost, self.pixel_cost,
+                                 self.limit//2
+                             )
+            else:
+                self.rects = [ bounds(self.rects) ]
+
+    def intersects(self, x, y, w, h):
+        for r in self.rects:
+            if intersect(r, (x, y, w, h)):
+                return True
+        return False
+
+    # remove and return dirty regions, optionally clipped to
+    # (x, y, w, h); damage outside of clip is retained
+    def pop(self, clip=None):
+        if clip is None:
+            rects, self.rects = self.rects, []
+            return rects
+        rects, keep = [], []
+        for r in self.rects:
+            i = intersect(r, clip)
+            if i is None:
+                keep.append(r)
+            else:
+                rects.append(i)
+                keep.extend( subtract(r, clip) )
+        self.rects = keep
+        return rects
+
+    def clear(self):
+        self.rects = []
@@ -3,20 +3,77 @@ try:
 except:
     from struct import pack
 
+from rfb.pixelformat import get_pixelformat
+from rfb.pixelbuffer import PixelBuffer
+
+try: # not available on most micropython ports
+    import zlib
+    zlib.compressobj
+except:
+    zlib = None
+
 RAWRECT = 0
 COPYRECT = 1
 RRERECT = 2
+CORRE = 4
+HEXTILE = 5
+ZRLE = 16
+
+# pseudo-encodings, extensions the client supports
+LAST_RECT = -224
+CURSOR = -239
+FENCE = -312
+CONTINUOUS_UPDATES = -313
+
+
+# rectangles released for re-use, by class (refer get() and release())
+_pools = {}
 
 
+# rectangles have no __dict__, sub-classes adding attributes must list
+# them in __slots__ (ignored by micropython)
+#
+# bytes are cached as serialised, and re-serialised only when the fields
+# they were serialised from have changed: the header (x, y, w, h) by
+# to_bytes() and the rectangle by sub-classes (refer cached()), so
+# rectangles sent unchanged frame to frame cost next to nothing
 class BasicRectangleBaseClass:
 
+    __slots__ = ('x', 'y', '_w', '_h', '_hkey', '_header', '_key', '_bytes')
+
     encoding = None
 
+    # max. rectangles of each class held for re-use
+    pool_size = 64
+
     def __init__(self, x, y, w, h):
         self.x = x
         self.y = y
         self._w = w
         self._h = h
+        # fields serialised, None until serialised (or re-used)
+        self._hkey = None
+        self._key = None
+
+    # return a rectangle, as cls(*args), re-using one released if any
+    @classmethod
+    def get(cls, *args, **kwargs):
+        pool = _pools.get(cls)
+        if pool:
+            rect = pool.pop()
+            rect.__init__(*args, **kwargs)
+            return rect
+        return cls(*args, **kwargs)
+
+    # release the rectangle for re-use by get(), once sent; it must not
+    # be used (or sent) again
+    def release(self):
+        self._hkey = self._key = self._header = self._bytes = None
+        pool = _pools.get(type(self))
+        if pool is None:
+            pool = _pools[type(self)] = []
+        if len(pool) < self.pool_size:
+            pool.append(self)
     
     @property
     def w(self): 
@@ -29,16 +86,41 @@ class BasicRectangleBaseClass:
     # return bytes or
     #   None = delete from rectangles
     #   False = no update required
+    # encoding is signed, pseudo-encodings are -ve
     def to_bytes(self):
-        return pack('>4HL',
-                    self.x, self.y,
-                    self.w, self.h,
-                    self.encoding
-               )
+        key = (self.x, self.y, self.w, self.h)
+        if key != self._hkey:
+            self._hkey = key
+            self._header = pack('>4Hl',
+                                self.x, self.y,
+                                self.w, self.h,
+                                self.encoding
+                           )
+        return self._header
+
+    # return bytes cached by cache() if serialised from key, else None
+    def cached(self, key):
+        if key == self._key:
+            return self._bytes
+
+    def cache(self, key, b):
+        self._key = key
+        self._bytes = b
+        return b
+
+    # as to_bytes() but return a list of bytes-like buffers, to be
+    # sent without concatenation
+    def to_buffers(self):
+        b = self.to_bytes()
+        if b is None or b is False:
+            return b
+        return [b]
 
 
 class CopyRect(BasicRectangleBaseClass):
 
+    __slots__ = ('src_x', 'src_y')
+
     encoding = COPYRECT
 
     def __init__(self,
@@ -51,25 +133,53 @@ class CopyRect(BasicRectangleBaseClass):
         self.src_y = src_y
 
     def to_bytes(self):
-        return super().to_bytes() \
-               + pack('>2H', self.src_x, self.src_y) 
+        header = super().to_bytes()
+        key = (header, self.src_x, self.src_y)
+        return self.cached(key) or self.cache(key,
+                   header + pack('>2H', self.src_x, self.src_y)
+               )
+
+
+# ends an update of uncounted rectangles (refer RfbSession.send_streamed())
+class LastRect(BasicRectangleBaseClass):
 
+    __slots__ = ()
 
+    encoding = LAST_RECT
+
+    def __init__(self):
+        super().__init__(0, 0, 0, 0)
+
+
+# a rectangle already encoded, buffers as returned by to_buffers() of
+# the rectangle encoded (refer FrameBuffer.cache)
+class EncodedRect(BasicRectangleBaseClass):
+
+    __slots__ = ('encoding', 'buffers')
+
+    def __init__(self, x, y, w, h, encoding, buffers):
+        super().__init__(x, y, w, h)
+        self.encoding = encoding
+        self.buffers = buffers
+
+    def to_bytes(self):
+        return b''.join(self.buffers)
+
+    def to_buffers(self):
+        return self.buffers
+
+
+# packed pixels are cached per pixel format (refer PixelFormat)
 def colour_to_pixel(colour, bpp, depth, big, true, masks, shifts):
-    if true:
-        v = 0
-        for channel, mask, shift in zip(colour, masks, shifts):
-            v += (channel & mask)<<shift
-        return pack(
-                    ('>' if big else '<') + \
-                    ('L' if bpp==32 else ('H' if bpp==16 else 'B')),
-                    v<<(bpp-depth) if big else v
-            )
-    # else: colourmap not implemented
+    return get_pixelformat(bpp, depth, big, true, masks, shifts).pack(colour)
 
 
+# the pixel format is held as the PixelFormat shared by all sessions
+# and rectangles of the format
 class ColourRectangleBaseClass(BasicRectangleBaseClass):
 
+    __slots__ = ('pixelformat',)
+
     def __init__(self, 
                  x, y, 
                  w, h, 
@@ -78,42 +188,60 @@ class ColourRectangleBaseClass(BasicRectangleBaseClass):
                  masks, shifts 
                 ):
         super().__init__(x, y, w, h)
-        self._bpp = bpp
-        self._depth = depth
-        self._big = big
-        self._true = true
-        self._masks = masks
-        self._shifts = shifts
+        self.pixelformat = get_pixelformat(bpp, depth, big, true,
+                                           masks, shifts)
 
     @property 
     def bpp(self): 
-        return self._bpp
+        return self.pixelformat.bpp
 
     @property
     def depth(self): 
-        return self._depth
+        return self.pixelformat.depth
 
     @property
     def big(self):
-        return self._big    
+        return self.pixelformat.big
 
     @property
     def true(self): 
-        return self._true
+        return self.pixelformat.true
     
     @property
     def masks(self):
-        return self._masks
+        return self.pixelformat.masks
     
     @property
     def shifts(self):
-        return self._shifts
+        return self.pixelformat.shifts
 
 
-class RawRect(ColourRectangleBaseClass):
+# fill, fill_rect, setpixel, blit and blit_mask are implemented by
+# PixelBuffer
+# pixels drawn by the drawing methods increment version, pixels written
+# to buffer directly must be followed by damage() for encodings of the
+# buffer (sub-classes) to be re-encoded
+class RawRect(PixelBuffer, ColourRectangleBaseClass):
+
+    __slots__ = ('buffer', 'version')
 
     encoding = RAWRECT
 
+    # estimated cost of sending a region in this encoding, bytes per
+    # rectangle and bytes per pixel as a fraction of bytes per pixel of
+    # the pixel format (refer damage.optimise()); pixels are costed as
+    # the mostly uniform background added when regions are merged
+    cost_rect = 12
+    cost_pixel = 1.0
+
+    # if True the encoding of a region may be sent to any session with
+    # the same pixel format (refer FrameBuffer.cache)
+    cacheable = True
+
+    # max. bytes of pixels of a rectangle held for re-use once released,
+    # larger buffers (e.g. of a full frame update) are freed
+    pool_buffer = 16384
+
     def __init__(self, 
                  x, y, 
                  w, h, 
@@ -122,36 +250,50 @@ class RawRect(ColourRectangleBaseClass):
                  masks, shifts 
                 ):
         super().__init__(x, y, w, h, bpp, depth, big, true, masks, shifts)
-        self.buffer = bytearray( (bpp//8)*w*h )
+        n = (bpp//8)*w*h
+        try:
+            # re-used (refer get()), pixels are undefined until drawn
+            if len(self.buffer) != n:
+                self.buffer = bytearray(n)
+        except AttributeError:
+            self.buffer = bytearray(n)
+        self.version = 0
 
-    def fill(self, colour):
-        bytespp = self.bpp//8
-        stop = self.w*self.h*bytespp
-        b = colour_to_pixel(colour, 
-                            self.bpp, self.depth, 
-                            self.big, self.true, 
-                            self.masks, self.shifts
-                           )
-        for i in range(0, stop, bytespp):
-            self.buffer[i : i+bytespp] = b 
+    @property
+    def bytespp(self):
+        return self.pixelformat.bytespp
 
-    def setpixel(self, x, y, colour):
-        bytespp = self.bpp//8
-        start = (y*self.w*bytespp) + (x * bytespp)
-        b = colour_to_pixel(colour, 
-                            self.bpp, self.depth, 
-                            self.big, self.true, 
-                            self.masks, self.shifts
-                           )
-        self.buffer[start : start+bytespp] = b
+    def pixel(self, colour):
+        return self.pixelformat.pack(colour)
+
+    def damage(self, x, y, w, h):
+        self.version += 1
+
+    # cache key of the encoding of the buffer by sub-classes, raw pixels
+    # are not cached (a copy of the buffer)
+    def encoded_key(self):
+        return (self.version, self.x, self.y, self.w, self.h)
     
     def to_bytes(self):
         return super().to_bytes() \
                + self.buffer
 
+    # pixels are sent from the buffer without copying
+    def to_buffers(self):
+        if self.encoding != RAWRECT: # sub-class encodings
+            return super().to_buffers()
+        return [ super().to_bytes(), memoryview(self.buffer) ]
+
+    # raw pixels are sent, or cached, from the buffer itself
+    def release(self):
+        if self.encoding != RAWRECT and len(self.buffer) <= self.pool_buffer:
+            super().release()
+
 
 class RRESubRect(ColourRectangleBaseClass):
 
+    __slots__ = ('colour',)
+
     def __init__(self,
                  x, y,
                  w, h, 
@@ -164,20 +306,21 @@ class RRESubRect(ColourRectangleBaseClass):
 
     def to_bytes(self):
         # non-standard encoding ... don't call super()
-        return colour_to_pixel(
-                    self.colour, 
-                    self.bpp, self.depth, 
-                    self.big, self.true, 
-                    self.masks, self.shifts
-               ) \
-               + pack('>4H', 
-                      self.x, self.y,
-                      self.w, self.h
+        # colours may be lists, modified in place
+        key = (tuple(self.colour), self.x, self.y, self.w, self.h)
+        return self.cached(key) or self.cache(key,
+                   self.pixelformat.pack(self.colour)
+                   + pack('>4H', 
+                          self.x, self.y,
+                          self.w, self.h
+                   )
                )
 
 
 class RRERect(ColourRectangleBaseClass):
 
+    __slots__ = ('bgcolour', 'subrectangles')
+
     encoding = RRERECT
 
     def __init__(self,
@@ -190,18 +333,344 @@ class RRERect(ColourRectangleBaseClass):
                 ):
         super().__init__(x, y, w, h, bpp, depth, big, true, masks, shifts)
         self.bgcolour = bgcolour
-        self.subrectangles = []
+        try: # re-used (refer get())
+            del self.subrectangles[:]
+        except AttributeError:
+            self.subrectangles = []
 
+    # subrectangles return the same bytes while unchanged, compared by
+    # identity first
     def to_bytes(self):
-        b = b''
+        header = super().to_bytes()
+        subs = tuple( rect.to_bytes() for rect in self.subrectangles )
+        key = (header, tuple(self.bgcolour), subs)
+        return self.cached(key) or self.cache(key,
+                   header
+                   + pack('>L',len(subs))
+                   + self.pixelformat.pack(self.bgcolour)
+                   + b''.join(subs)
+               )
+
+    # subrectangles are released too
+    def release(self):
         for rect in self.subrectangles:
-            b += rect.to_bytes()
-        return super().to_bytes() \
-               + pack('>L',len(self.subrectangles)) \
-               + colour_to_pixel(
-                    self.bgcolour, 
-                    self.bpp, self.depth, 
-                    self.big, self.true, 
-                    self.masks, self.shifts
-               ) + b
+            rect.release()
+        del self.subrectangles[:]
+        super().release()
+
+
+
+# greedily cover pixels (list of w*h pixel values, row by row) not of
+# colour bg with the fewest solid rectangles found by growing right
+# then down from each uncovered pixel, returns (pixel, x, y, w, h)'s
+def subrects(pixels, w, h, bg):
+    covered = bytearray(w*h)
+    rects = []
+    for y in range(h):
+        row = y*w
+        for x in range(w):
+            p = pixels[row+x]
+            if p == bg or covered[row+x]:
+                continue
+            # grow right
+            x2 = x+1
+            while x2 < w and pixels[row+x2] == p and not covered[row+x2]:
+                x2 += 1
+            # grow down while the whole span matches
+            y2 = y+1
+            while y2 < h:
+                r = y2*w
+                if any( pixels[r+i] != p or covered[r+i] for i in range(x, x2) ):
+                    break
+                y2 += 1
+            for r in range(y, y2):
+                covered[r*w+x : r*w+x2] = b'\x01'*(x2-x)
+            rects.append( (p, x, y, x2-x, y2-y) )
+    return rects
+
+
+class AutoRRERect(RawRect):
+
+    __slots__ = ()
+
+    encoding = RRERECT
+    cost_rect = 20
+    cost_pixel = 0.01
+
+    # RRE encode the pixel buffer; the most common colour is the
+    # background, subrectangles are found by subrects(), sent as a
+    # RawRect if that is smaller
+    def to_bytes(self):
+        key = self.encoded_key()
+        return self.cached(key) or self.cache(key, self.encode())
+
+    def encode(self):
+        bytespp = self.bpp//8
+        buffer = bytes(self.buffer)
+        pixels = [
+            buffer[i : i+bytespp] for i in range(0, len(buffer), bytespp)
+        ]
+        counts = {}
+        for p in pixels:
+            counts[p] = counts.get(p, 0) + 1
+        bg = max(counts, key=counts.get)
+        rects = subrects(pixels, self.w, self.h, bg)
+        if len(rects)*(bytespp+self.subrect_size) + bytespp + 4 \
+                >= len(buffer):
+            return pack('>4HL', self.x, self.y, self.w, self.h, RAWRECT) \
+                   + self.buffer
+        b = [ super(RawRect, self).to_bytes(), pack('>L', len(rects)), bg ]
+        for p, x, y, w, h in rects:
+            b.append( p + self.subrect(x, y, w, h) )
+        return b''.join(b)
+
+    subrect_size = 8
+
+    def subrect(self, x, y, w, h):
+        return pack('>4H', x, y, w, h)
+
+
+class CoRRERect(AutoRRERect):
+
+    __slots__ = ()
+
+    # compact RRE, w and h must be less than 256
+    encoding = CORRE
+
+    subrect_size = 4
+
+    def subrect(self, x, y, w, h):
+        return bytes( (x, y, w, h) )
+
+
+class HextileRect(RawRect):
+
+    __slots__ = ()
+
+    encoding = HEXTILE
+    cost_rect = 16
+    cost_pixel = 0.005 # 1 byte per solid tile
+
+    # tile sub-encoding mask bits
+    RAW = 1
+    BACKGROUND = 2
+    FOREGROUND = 4
+    ANYSUBRECTS = 8
+    COLOURED = 16
+
+    def to_bytes(self):
+        key = self.encoded_key()
+        return self.cached(key) or self.cache(key, self.encode())
 
+    def encode(self):
+        bytespp = self.bpp//8
+        stride = self.w*bytespp
+        b = []
+        # bg/fg persist from tile to tile, None == undefined
+        bg = fg = None
+        for ty in range(0, self.h, 16):
+            th = min(16, self.h-ty)
+            for tx in range(0, self.w, 16):
+                tw = min(16, self.w-tx)
+                pixels = []
+                for r in range(ty, ty+th):
+                    start = (r*stride) + (tx*bytespp)
+                    row = bytes(self.buffer[start : start+(tw*bytespp)])
+                    pixels.extend(
+                        row[i : i+bytespp] for i in range(0, len(row), bytespp)
+                    )
+                tile, bg, fg = self.tile(pixels, tw, th, bg, fg)
+                b.append(tile)
+        return super(RawRect, self).to_bytes() + b''.join(b)
+
+    # return (tile encoding, background, foreground), colours
+    # returned are those in effect for the next tile
+    def tile(self, pixels, w, h, bg, fg):
+        counts = {}
+        for p in pixels:
+            counts[p] = counts.get(p, 0) + 1
+        tile_bg = max(counts, key=counts.get)
+        mask = 0
+        b = b''
+        if tile_bg != bg:
+            mask |= self.BACKGROUND
+            b += tile_bg
+        if len(counts) == 1:
+            return bytes((mask,)) + b, tile_bg, fg
+        rects = subrects(pixels, w, h, tile_bg)
+        if len(rects) < 256:
+            mask |= self.ANYSUBRECTS
+            if len(counts) == 2:
+                tile_fg = rects[0][0]
+                if tile_fg != fg:
+                    mask |= self.FOREGROUND
+                    b += tile_fg
+                b += bytes((len(rects),))
+                for p, x, y, rw, rh in rects:
+                    b += bytes(( (x<<4)|y, ((rw-1)<<4)|(rh-1) ))
+            else:
+                mask |= self.COLOURED
+                tile_fg = None
+                b += bytes((len(rects),))
+                for p, x, y, rw, rh in rects:
+                    b += p + bytes(( (x<<4)|y, ((rw-1)<<4)|(rh-1) ))
+            if len(b) < len(pixels)*len(tile_bg):
+                return bytes((mask,)) + b, tile_bg, tile_fg
+        # raw is smaller, bg/fg are undefined after a raw tile
+        return bytes((self.RAW,)) + b''.join(pixels), None, None
+
+
+class ZRLERect(RawRect):
+
+    __slots__ = ('zstream',)
+
+    encoding = ZRLE
+    cost_rect = 24
+    cost_pixel = 0.002
+    # compressed with the session's zlib stream, tiles are cached
+    # before compression
+    cacheable = False
+
+    # zstream must be the session's zlib compressor, a single
+    # stream is used for the lifetime of an RFB session
+    def __init__(self,
+                 x, y,
+                 w, h,
+                 bpp, depth,
+                 big, true,
+                 masks, shifts,
+                 zstream=None
+                ):
+        super().__init__(x, y, w, h, bpp, depth, big, true, masks, shifts)
+        self.zstream = zstream
+
+    # return slice of pixel bytes sent as a CPIXEL
+    def cpixel(self):
+        bytespp = self.bpp//8
+        if self.true and self.bpp == 32 and self.depth <= 24:
+            top = max( m<<s for m, s in zip(self.masks, self.shifts) )
+            if top < 1<<24: # least significant 3 bytes
+                return (1, 4) if self.big else (0, 3)
+            if min( s for s in self.shifts ) >= 8: # most significant
+                return (0, 3) if self.big else (1, 4)
+        return (0, bytespp)
+
+    def to_bytes(self):
+        key = self.encoded_key()
+        b = self.cached(key) or self.cache(key, self.encode())
+        z = self.zstream.compress(b) \
+            + self.zstream.flush(zlib.Z_SYNC_FLUSH)
+        return super(RawRect, self).to_bytes() + pack('>L', len(z)) + z
+
+    # return the tiles, uncompressed
+    def encode(self):
+        bytespp = self.bpp//8
+        stride = self.w*bytespp
+        start, stop = self.cpixel()
+        b = []
+        for ty in range(0, self.h, 64):
+            th = min(64, self.h-ty)
+            for tx in range(0, self.w, 64):
+                tw = min(64, self.w-tx)
+                pixels = []
+                for r in range(ty, ty+th):
+                    offset = (r*stride) + (tx*bytespp)
+                    row = bytes(self.buffer[offset : offset+(tw*bytespp)])
+                    pixels.extend(
+                        row[i+start : i+stop]
+                        for i in range(0, len(row), bytespp)
+                    )
+                b.append( self.tile(pixels, tw, th) )
+        return b''.join(b)
+
+    # return the smallest of the tile's raw, solid, packed palette,
+    # plain RLE or palette RLE sub-encodings
+    def tile(self, pixels, w, h):
+        runs = []
+        for p in pixels:
+            if runs and runs[-1][0] == p:
+                runs[-1][1] += 1
+            else:
+                runs.append( [p, 1] )
+        # colour index, and colours in index order
+        palette, colours = {}, []
+        for p, l in runs:
+            if p not in palette:
+                palette[p] = len(colours)
+                colours.append(p)
+        if len(palette) == 1:
+            return b'\x01' + pixels[0]
+        cp = len(pixels[0])
+        # (size, sub-encoding)
+        best = (len(pixels)*cp, 0)
+        # plain RLE
+        size = sum( cp + (l-1)//255 + 1 for p, l in runs )
+        best = min(best, (size, 128))
+        if len(palette) < 128:
+            size = len(palette)*cp \
+                   + sum( 1 if l == 1 else 1 + (l-1)//255 + 1 for p, l in runs )
+            best = min(best, (size, 128+len(palette)))
+        if len(palette) <= 16:
+            bits = 1 if len(palette) == 2 else (2 if len(palette) <= 4 else 4)
+            size = len(palette)*cp + h*((w*bits+7)//8)
+            best = min(best, (size, len(palette)))
+        sub = best[1]
+        if sub == 0:
+            return b'\x00' + b''.join(pixels)
+        b = bytearray( (sub,) )
+        if sub == 128:
+            for p, l in runs:
+                b += p
+                b += self.runlength(l)
+        elif sub > 128:
+            b += b''.join(colours)
+            for p, l in runs:
+                if l == 1:
+                    b.append( palette[p] )
+                else:
+                    b.append( palette[p] | 128 )
+                    b += self.runlength(l)
+        else:
+            b += b''.join(colours)
+            bits = 1 if sub == 2 else (2 if sub <= 4 else 4)
+            for r in range(h):
+                v = n = 0
+                for p in pixels[r*w : (r+1)*w]:
+                    v = (v<<bits) | palette[p]
+                    n += bits
+                    if n == 8:
+                        b.append(v)
+                        v = n = 0
+                if n:
+                    b.append( v<<(8-n) )
+        return bytes(b)
+
+    @staticmethod
+    def runlength(l):
+        l -= 1
+        return b'\xff'*(l//255) + bytes( (l%255,) )
+
+
+# cursor shape, drawn by the client at the pointer position, x,y is the
+# hotspot (within the cursor) and mask is w*h bits, rows padded to whole
+# bytes, 1 where the cursor is drawn; pixels may be drawn as RawRect
+class CursorRect(RawRect):
+
+    __slots__ = ('mask',)
+
+    encoding = CURSOR
+
+    def __init__(self,
+                 x, y,
+                 w, h,
+                 bpp, depth,
+                 big, true,
+                 masks, shifts,
+                 mask
+                ):
+        super().__init__(x, y, w, h, bpp, depth, big, true, masks, shifts)
+        self.mask = mask
+
+    def to_bytes(self):
+        return super().to_bytes() \
+               + self.mask
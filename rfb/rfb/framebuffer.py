@@ -0,0 +1,207 @@
+from rfb.damage import Damage, intersect, subtract, bounds
+from rfb.framediff import find_move, TileDiff
+from rfb.encodings import RawRect
+from rfb.pixelbuffer import PixelBuffer
+
+
+# fill, fill_rect, setpixel, blit and blit_mask are implemented by
+# PixelBuffer, and add damage
+class FrameBuffer(PixelBuffer):
+
+    bytespp = 3
+
+    # if True commit() detects damaged regions whose content has been
+    # scrolled (moved vertically or horizontally), which are sent to
+    # sessions as a CopyRect, and only the exposed strip as damage;
+    # requires a copy of the previous frame
+    detect_moves = False
+    # min. pixels moved for a CopyRect to be sent
+    move_min = 1024
+    # tile size (pixels) if commit() is to publish only the tiles of
+    # damaged regions whose content has changed (refer TileDiff), for
+    # applications redrawing whole frames; 0 to publish all damage
+    diff_tile = 0
+    # max. regions whose encoding is kept, while more than one session
+    # is attached, to be sent to every session with the same pixel
+    # format and encoding; 0 to encode for each session
+    cache_limit = 64
+
+    # server side canvas shared by all sessions, pixels are held
+    # as packed (r,g,b) bytes and converted to each session's
+    # pixel format only when a damaged region is sent
+    def __init__(self, w, h):
+        self.w = w
+        self.h = h
+        self.buffer = bytearray(w*h*3)
+        self.sessions = []
+        # damage since last commit()
+        self.damaged = Damage()
+        # frame as at last commit(), if detect_moves
+        self.previous = None
+        # per-tile change detection, if diff_tile
+        self.tiles = None
+        # (x, y, w, h, pixel format key, encoder) -> buffers, evicted
+        # when the region is next damaged
+        self.cache = {}
+
+    def attach(self, session):
+        self.sessions.append(session)
+        session.framebuffer = self
+        # client framebuffer content is undefined at session start
+        session.damage.add(0, 0, self.w, self.h)
+
+    def detach(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+
+    def pixel(self, colour):
+        return bytes(colour)
+
+    def damage(self, x, y, w, h):
+        self.damaged.add( *self.clip(x, y, w, h) )
+
+    # publish damage accumulated since last commit to sessions,
+    # normally called once per server loop by RfbServer.service()
+    def commit(self):
+        if not self.damaged:
+            return
+        self.evict()
+        if self.diff_tile:
+            if self.tiles is None:
+                self.tiles = TileDiff(self.w, self.h, 3, self.diff_tile)
+            # tiles may span more than one damaged region
+            tiles = [ t for r in self.damaged.rects
+                        for t in self.tiles.diff(self.buffer, *r) ]
+        dests = []
+        for r, move, damaged in self.regions():
+            # regions of r changed
+            if self.diff_tile:
+                changed = [ i for t in tiles for d in damaged
+                              for i in (intersect(d, t),) if i ]
+            else:
+                changed = damaged
+            if move is not None:
+                src = (move[4], move[5], move[2], move[3])
+                # source must be as at last commit at the client
+                if any( intersect(src, d) for d in dests ):
+                    move = None
+                else:
+                    dests.append(move[:4])
+                    exposed = [ i for strip in subtract(r, move[:4])
+                                  for c in changed
+                                  for i in (intersect(strip, c),) if i ]
+            for session in self.sessions:
+                if move is not None and not session.damage.intersects(*src):
+                    session.moves.append(move)
+                    for e in exposed:
+                        session.damage.add(*e)
+                else:
+                    for c in changed:
+                        session.damage.add(*c)
+        if self.detect_moves:
+            self.snapshot()
+        self.damaged.clear()
+
+    # return the cache key of region x,y,w,h encoded by encoder in
+    # PixelFormat pf, or None if the encoding is not to be cached
+    def cache_key(self, x, y, w, h, pf, encoder):
+        # a region drawn since the last commit may differ from the
+        # cached encoding
+        if not encoder.cacheable or not self.cache_limit \
+           or len(self.sessions) < 2 or self.damaged:
+            return None
+        return (x, y, w, h, pf.key, encoder)
+
+    def cache_add(self, key, buffers):
+        if len(self.cache) >= self.cache_limit:
+            # oldest (cpython), any (micropython)
+            del self.cache[ next(iter(self.cache)) ]
+        self.cache[key] = buffers
+
+    # remove cached encodings of regions damaged since the last commit
+    def evict(self):
+        if not self.cache:
+            return
+        for key in list(self.cache):
+            for r in self.damaged.rects:
+                if intersect(key, r):
+                    del self.cache[key]
+                    break
+
+    # return damaged regions as (region, move or None, damaged rects
+    # within it): touching rects, e.g. a scrolled region and the strip
+    # it exposed, are one region (their bounds) if it has moved as one,
+    # else each is a region searched for moves on its own
+    def regions(self):
+        rects = self.damaged.rects
+        if not self.detect_moves or self.previous is None:
+            return [ (r, None, [r]) for r in rects ]
+        # group rects touching (or overlapping) each other
+        groups = []
+        for r in rects:
+            near = (r[0]-1, r[1]-1, r[2]+2, r[3]+2)
+            touching = [ g for g in groups
+                         if any( intersect(near, o) for o in g ) ]
+            for g in touching:
+                groups.remove(g)
+            groups.append( [r] + [ o for g in touching for o in g ] )
+        regions = []
+        for g in groups:
+            if len(g) > 1:
+                b = bounds(g)
+                move = self.move(*b)
+                if move is not None:
+                    regions.append( (b, move, g) )
+                    continue
+            regions.extend( (r, self.move(*r), [r]) for r in g )
+        return regions
+
+    # return (x, y, w, h, src_x, src_y) if region x,y,w,h of the last
+    # commit has moved to x,y,w,h, else None
+    def move(self, x, y, w, h):
+        if not self.detect_moves or self.previous is None:
+            return None
+        found = find_move(self.buffer, self.previous, self.w*3, 3, x, y, w, h)
+        if found is None:
+            return None
+        dx, dy, (first, last) = found
+        # columns of the region moved
+        mx, mw = x+max(0, -dx), w-abs(dx)
+        if mw*(last-first) < self.move_min:
+            return None
+        return mx, y+first, mw, last-first, mx+dx, y+first+dy
+
+    # copy damaged regions to the previous frame
+    def snapshot(self):
+        if self.previous is None:
+            self.previous = bytearray(self.buffer)
+            return
+        stride = self.w*3
+        for x, y, w, h in self.damaged.rects:
+            for r in range(y, y+h):
+                start = (r*stride) + (x*3)
+                self.previous[start : start+(w*3)] = \
+                    self.buffer[start : start+(w*3)]
+
+    def getpixel(self, x, y):
+        start = (y*self.w*3) + (x*3)
+        return tuple(self.buffer[start : start+3])
+
+    # return a RawRect (or sub-class cls) of region x,y,w,h in the
+    # pixel format given, which may be released once sent (refer
+    # BasicRectangleBaseClass.release())
+    def rect(self, x, y, w, h, bpp, depth, big, true, masks, shifts,
+             cls=RawRect):
+        rect = cls.get(x, y, w, h, bpp, depth, big, true, masks, shifts)
+        pf = rect.pixelformat
+        stride = self.w*3
+        if w == self.w:
+            # rows are contiguous
+            rgb = self.buffer[y*stride : (y+h)*stride]
+        else:
+            rgb = b''.join(
+                self.buffer[(r*stride)+(x*3) : (r*stride)+((x+w)*3)]
+                for r in range(y, y+h)
+            )
+        rect.buffer[:] = pf.convert(rgb)
+        return rect
@@ -0,0 +1,199 @@
+try: # optional, used for large framebuffers
+    import numpy
+except:
+    numpy = None
+
+# compare regions of a framebuffer with the previous frame, buffers are
+# rows of stride bytes, of pixels of bytespp bytes
+
+
+# return (dx, dy, rows) if the content of region x,y,w,h has moved by
+# whole pixels vertically (dx == 0) or horizontally (dy == 0) since
+# previous, content at current (x, y) being at previous (x+dx, y+dy),
+# rows is the (first, last+1) rows of the region found moved, or None
+def find_move(current, previous, stride, bytespp, x, y, w, h):
+    move = find_vertical(current, previous, stride, bytespp, x, y, w, h)
+    if move is None:
+        move = find_horizontal(current, previous, stride, bytespp, x, y, w, h)
+    return move
+
+def rows(buffer, stride, start, rowlen, h):
+    return [ bytes(buffer[start+(r*stride) : start+(r*stride)+rowlen])
+             for r in range(h) ]
+
+# return longest run (first, last+1) of rows where match(r) is True
+def longest_run(match, h):
+    best = (0, 0)
+    first = None
+    for r in range(h+1):
+        if r < h and match(r):
+            if first is None:
+                first = r
+        elif first is not None:
+            if r-first > best[1]-best[0]:
+                best = (first, r)
+            first = None
+    return best
+
+# vote for the row offset most rows have moved by, using row hashes
+def find_vertical(current, previous, stride, bytespp, x, y, w, h):
+    start = (y*stride) + (x*bytespp)
+    rowlen = w*bytespp
+    cur = rows(current, stride, start, rowlen, h)
+    prev = rows(previous, stride, start, rowlen, h)
+    # hash -> row in previous, None if not unique (e.g. blank rows)
+    where = {}
+    for r, row in enumerate(prev):
+        k = hash(row)
+        where[k] = None if k in where else r
+    votes = {}
+    for r, row in enumerate(cur):
+        p = where.get(hash(row))
+        if p is not None and p != r:
+            votes[p-r] = votes.get(p-r, 0) + 1
+    if not votes:
+        return None
+    dy = max(votes, key=votes.get)
+    run = longest_run(
+              lambda r: 0 <= r+dy < h and cur[r] == prev[r+dy], h
+          )
+    return 0, dy, run
+
+# search a few rows of previous for the middle of the current row
+def find_horizontal(current, previous, stride, bytespp, x, y, w, h):
+    start = (y*stride) + (x*bytespp)
+    rowlen = w*bytespp
+    lo, hi = (w//4)*bytespp, (w-(w//4))*bytespp
+    if hi-lo < bytespp*4:
+        return None
+    for r in (h//2, h//4, h-1-(h//4)):
+        row = bytes(current[start+(r*stride) : start+(r*stride)+rowlen])
+        segment = row[lo:hi]
+        if segment == segment[:bytespp]*(len(segment)//bytespp):
+            continue # uniform, found anywhere
+        prev = bytes(previous[start+(r*stride) : start+(r*stride)+rowlen])
+        found = prev.find(segment)
+        while found >= 0 and (found-lo) % bytespp:
+            found = prev.find(segment, found+1)
+        if found < 0 or found == lo:
+            continue
+        dx = (found-lo)//bytespp
+        # columns of the current row present in the previous row
+        a, b = max(0, -dx)*bytespp, (w-max(0, dx))*bytespp
+        d = dx*bytespp
+        def match(r):
+            o = start + (r*stride)
+            return current[o+a : o+b] == previous[o+a+d : o+b+d]
+        return dx, 0, longest_run(match, h)
+    return None
+
+
+# framebuffer split into size x size pixel tiles, diff() returns the tiles
+# changed since the last diff(); a hash of each tile is kept or, with
+# numpy for frames of numpy_threshold pixels or more, a copy of the frame
+# is compared in one vectorised operation
+class TileDiff():
+
+    numpy_threshold = 4096
+
+    def __init__(self, w, h, bytespp=3, size=16):
+        self.w = w
+        self.h = h
+        self.bytespp = bytespp
+        self.size = size
+        self.cols = (w+size-1)//size
+        self.rows = (h+size-1)//size
+        self.numpy = numpy is not None and w*h >= self.numpy_threshold
+        # tile hashes, or previous frame (numpy), set by the first diff
+        self.hashes = None
+        self.previous = None
+        # tiles not yet diffed (numpy), changed at their first diff
+        self.fresh = None
+
+    # return rectangles (x, y, w, h) covering the tiles of region
+    # x,y,w,h (default the whole frame) of buffer changed since the last
+    # diff, everything has changed at the first diff
+    def diff(self, buffer, x=0, y=0, w=None, h=None):
+        w = self.w-x if w is None else w
+        h = self.h-y if h is None else h
+        s = self.size
+        tx0, ty0 = max(0, x//s), max(0, y//s)
+        tx1 = min(self.cols, (x+w+s-1)//s)
+        ty1 = min(self.rows, (y+h+s-1)//s)
+        if tx1 <= tx0 or ty1 <= ty0:
+            return []
+        if self.numpy:
+            tiles = self.diff_numpy(buffer, tx0, ty0, tx1, ty1)
+        else:
+            tiles = self.diff_hash(buffer, tx0, ty0, tx1, ty1)
+        return self.rects(tiles, tx0, ty0)
+
+    # return rows of tiles, True if changed
+    def diff_hash(self, buffer, tx0, ty0, tx1, ty1):
+        s = self.size
+        bytespp = self.bytespp
+        stride = self.w*bytespp
+        if self.hashes is None:
+            self.hashes = [None]*(self.cols*self.rows)
+        tiles = []
+        for ty in range(ty0, ty1):
+            row = []
+            rows = range(ty*s, min((ty+1)*s, self.h))
+            for tx in range(tx0, tx1):
+                a = tx*s*bytespp
+                b = min((tx+1)*s, self.w)*bytespp
+                k = hash( b''.join(
+                        buffer[(r*stride)+a : (r*stride)+b] for r in rows
+                    ) )
+                i = (ty*self.cols)+tx
+                row.append(k != self.hashes[i])
+                self.hashes[i] = k
+            tiles.append(row)
+        return tiles
+
+    def diff_numpy(self, buffer, tx0, ty0, tx1, ty1):
+        s = self.size
+        frame = numpy.frombuffer(buffer, dtype=numpy.uint8) \
+                     .reshape(self.h, self.w, self.bytespp)
+        if self.previous is None:
+            self.previous = frame.copy()
+            self.fresh = numpy.ones( (self.rows, self.cols), dtype=bool )
+        x0, y0 = tx0*s, ty0*s
+        x1, y1 = min(tx1*s, self.w), min(ty1*s, self.h)
+        current = frame[y0:y1, x0:x1]
+        changed = numpy.zeros( ((ty1-ty0)*s, (tx1-tx0)*s), dtype=bool )
+        changed[:y1-y0, :x1-x0] = \
+            (current != self.previous[y0:y1, x0:x1]).any(axis=2)
+        self.previous[y0:y1, x0:x1] = current
+        fresh = self.fresh[ty0:ty1, tx0:tx1]
+        tiles = changed.reshape(ty1-ty0, s, tx1-tx0, s) \
+                       .any(axis=(1, 3)) | fresh
+        fresh[:] = False
+        return tiles.tolist()
+
+    # merge changed tiles, horizontally adjacent into runs, and runs
+    # spanning the same columns in consecutive rows
+    def rects(self, tiles, tx0, ty0):
+        s = self.size
+        rects = []
+        above = {}
+        for j, row in enumerate(tiles):
+            runs = {}
+            i = 0
+            while i < len(row):
+                if not row[i]:
+                    i += 1
+                    continue
+                k = i
+                while k < len(row) and row[k]:
+                    k += 1
+                r = above.get( (i, k) )
+                if r is None:
+                    r = [(tx0+i)*s, (ty0+j)*s, (k-i)*s, 0]
+                    rects.append(r)
+                r[3] += s
+                runs[ (i, k) ] = r
+                i = k
+            above = runs
+        return [ (x, y, min(w, self.w-x), min(h, self.h-y))
+                 for x, y, w, h in rects ]
@@ -0,0 +1,157 @@
+from rfb.utils import bytes_to_int
+
+try: # optional, used for large buffers
+    import numpy
+except:
+    numpy = None
+
+
+class PixelBuffer():
+
+    # no instance attributes (refer encodings.BasicRectangleBaseClass)
+    __slots__ = ()
+
+    # drawing methods shared by RawRect and FrameBuffer, which provide
+    # w, h, buffer (rows of w pixels of bytespp bytes), bytespp, and
+    # pixel(colour) returning the bytes of colour in the buffer's format
+
+    # blits of at least this many pixels are drawn with numpy, fills
+    # are faster as row slice assignment
+    numpy_threshold = 4096
+
+    # called with each region drawn
+    def damage(self, x, y, w, h):
+        pass
+
+    # return x, y, w, h clipped to the buffer
+    def clip(self, x, y, w, h):
+        if x < 0:
+            w += x
+            x = 0
+        if y < 0:
+            h += y
+            y = 0
+        return x, y, min(w, self.w-x), min(h, self.h-y)
+
+    # return buffer as a (h, w, bytespp) numpy array, if numpy is
+    # available and pixels drawn is at least numpy_threshold
+    def view(self, pixels):
+        if numpy is not None and pixels >= self.numpy_threshold:
+            return numpy.frombuffer(self.buffer, dtype=numpy.uint8) \
+                        .reshape(self.h, self.w, self.bytespp)
+
+    def fill(self, colour):
+        self.buffer[:] = self.pixel(colour)*(self.w*self.h)
+        self.damage(0, 0, self.w, self.h)
+
+    def fill_rect(self, x, y, w, h, colour):
+        x, y, w, h = self.clip(x, y, w, h)
+        if w < 1 or h < 1:
+            return
+        p = self.pixel(colour)
+        if w == self.w:
+            # rows are contiguous
+            start = y*self.w*self.bytespp
+            self.buffer[start : start+(w*h*self.bytespp)] = p*(w*h)
+        else:
+            row = p*w
+            stride = self.w*self.bytespp
+            start = (y*stride) + (x*self.bytespp)
+            for r in range(h):
+                self.buffer[start : start+len(row)] = row
+                start += stride
+        self.damage(x, y, w, h)
+
+    def setpixel(self, x, y, colour):
+        start = (y*self.w + x)*self.bytespp
+        self.buffer[start : start+self.bytespp] = self.pixel(colour)
+        self.damage(x, y, 1, 1)
+
+    # copy w x h pixels, in the buffer's format, from src (bytes,
+    # bytearray or memoryview) whose rows are stride bytes apart; src
+    # may be (a view of) the buffer itself e.g. to scroll
+    def blit(self, x, y, w, h, src, stride=None):
+        bytespp = self.bytespp
+        if stride is None:
+            stride = w*bytespp
+        # a view's offset within the buffer isn't known (and micropython
+        # views have no obj), so any view may overlap the buffer
+        aliased = src is self.buffer or type(src) is memoryview \
+                  and getattr(src, 'obj', self.buffer) is self.buffer
+        src = memoryview(src)
+        # clip, offsetting src
+        cx, cy, cw, ch = self.clip(x, y, w, h)
+        if cw < 1 or ch < 1:
+            return
+        offset = ((cy-y)*stride) + ((cx-x)*bytespp)
+        view = self.view(cw*ch)
+        if view is not None and len(src) >= offset + ch*stride:
+            view[cy:cy+ch, cx:cx+cw] = numpy.frombuffer(
+                    src, dtype=numpy.uint8, count=ch*stride, offset=offset
+                ).reshape(ch, stride)[:, :cw*bytespp].reshape(ch, cw, bytespp)
+        else:
+            rowlen = cw*bytespp
+            dst_stride = self.w*bytespp
+            dst = (cy*dst_stride) + (cx*bytespp)
+            if cw == w == self.w and stride == rowlen:
+                self.buffer[dst : dst+(rowlen*ch)] = \
+                    src[offset : offset+(rowlen*ch)]
+            else:
+                if aliased and ch > 1:
+                    # rows copied first, row by row they may overwrite
+                    # source rows not yet copied
+                    src = bytes(src[offset : offset+(ch-1)*stride+rowlen])
+                    offset = 0
+                for r in range(ch):
+                    self.buffer[dst : dst+rowlen] = src[offset : offset+rowlen]
+                    dst += dst_stride
+                    offset += stride
+        self.damage(cx, cy, cw, ch)
+
+    # expand a 1-bit mask of w*h bits, most significant bit first,
+    # (e.g. Font.getbitmap_bytes()) to fg and bg colour pixels,
+    # pixels of 0 bits are left unchanged if bg is None
+    def blit_mask(self, x, y, w, h, mask, fg, bg=None):
+        cx, cy, cw, ch = self.clip(x, y, w, h)
+        if cw < 1 or ch < 1:
+            return
+        fg = self.pixel(fg)
+        bg = None if bg is None else self.pixel(bg)
+        bytespp = self.bytespp
+        # visible columns
+        lo, hi = cx-x, cx+cw-x
+        view = self.view(w*h)
+        if view is not None:
+            bits = numpy.unpackbits(
+                       numpy.frombuffer(mask, dtype=numpy.uint8)
+                   )[-(w*h):].reshape(h, w).astype(bool)
+            bits = bits[cy-y : cy-y+ch, cx-x : cx-x+cw]
+            region = view[cy:cy+ch, cx:cx+cw]
+            region[bits] = numpy.frombuffer(fg, dtype=numpy.uint8)
+            if bg is not None:
+                region[~bits] = numpy.frombuffer(bg, dtype=numpy.uint8)
+            self.damage(cx, cy, cw, ch)
+            return
+        try:
+            bits = int.from_bytes(mask, 'big')
+        except: # micropython
+            bits = bytes_to_int(mask)
+        # as fonts, leading bits beyond w*h are padding
+        bits &= (1<<(w*h))-1
+        for r in range(h):
+            if not 0 <= y+r < self.h:
+                continue
+            row = (bits >> ((h-1-r)*w)) & ((1<<w)-1)
+            start = ((y+r)*self.w + x)*bytespp
+            if bg is not None:
+                # whole row at once
+                pixels = b''.join(
+                    fg if (row >> (w-1-i)) & 1 else bg for i in range(lo, hi)
+                )
+                self.buffer[start+(lo*bytespp) : start+(hi*bytespp)] = pixels
+            else:
+                for i in range(lo, hi):
+                    if (row >> (w-1-i)) & 1:
+                        p = start+(i*bytespp)
+                        self.buffer[p : p+bytespp] = fg
+        self.damage(cx, cy, cw, ch)
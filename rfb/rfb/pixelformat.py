@@ -0,0 +1,222 @@
+try:
+    from ustruct import pack
+except:
+    from struct import pack
+
+try: # optional, fills palette lookup tables at once
+    import numpy
+except:
+    numpy = None
+
+
+# colour map of up to 256 (r,g,b) colours, for pixel formats that are
+# not true-colour; not modified once in use, a new Palette is set as
+# PixelFormat.palette to change colours
+#
+# colours are looked up by their 5 most significant bits per channel
+# in a table of 32x32x32 cells, each the index of the palette colour
+# nearest the cell's centre (or of a palette colour within the cell)
+class Palette():
+
+    def __init__(self, colours):
+        self.colours = [ tuple(c) for c in colours[:256] ]
+        # built when first used (refer lut())
+        self._lut = None
+        self._filled = None
+
+    def __len__(self):
+        return len(self.colours)
+
+    # return the lookup table, cells are filled as first looked up
+    # (refer index()), or all at once with numpy
+    def lut(self):
+        if self._lut is None:
+            self._lut = bytearray(32768)
+            self._filled = bytearray(32768)
+            if numpy is not None:
+                self.fill()
+            # the first of any palette colours within a cell
+            for i in range(len(self.colours)-1, -1, -1):
+                k = cell(*self.colours[i])
+                self._lut[k] = i
+                self._filled[k] = 1
+        return self._lut
+
+    # fill every cell with numpy, a red level at a time; the squared
+    # distance less the cell's own |c|^2 is |p|^2 - 2c.p
+    def fill(self):
+        colours = numpy.array(self.colours, dtype=numpy.int32)
+        squares = (colours*colours).sum(axis=1)
+        levels = (numpy.arange(32, dtype=numpy.int32) << 3) | 4
+        g, b = numpy.meshgrid(levels, levels, indexing='ij')
+        cells = numpy.zeros((1024, 3), dtype=numpy.int32)
+        cells[:, 1], cells[:, 2] = g.ravel(), b.ravel()
+        for r in range(32):
+            cells[:, 0] = levels[r]
+            d = squares[None, :] - 2*(cells @ colours.T)
+            self._lut[r*1024 : (r+1)*1024] = \
+                d.argmin(axis=1).astype(numpy.uint8).tobytes()
+        self._filled[:] = b'\x01'*32768
+
+    # return the index of the palette colour nearest to the centre of
+    # cell k
+    def nearest(self, k):
+        r, g, b = ((k>>10)<<3)|4, (((k>>5)&31)<<3)|4, ((k&31)<<3)|4
+        nearest = i = None
+        for n, (pr, pg, pb) in enumerate(self.colours):
+            d = (r-pr)*(r-pr) + (g-pg)*(g-pg) + (b-pb)*(b-pb)
+            if nearest is None or d < nearest:
+                nearest, i = d, n
+        return i
+
+    # return the index of the palette colour nearest to colour (r,g,b),
+    # a tuple, list or bytes
+    def index(self, colour):
+        lut = self.lut()
+        k = cell(colour[0], colour[1], colour[2])
+        if not self._filled[k]:
+            lut[k] = self.nearest(k)
+            self._filled[k] = 1
+        return lut[k]
+
+    # return bytes of the indices of packed (r,g,b) bytes
+    def indices(self, rgb):
+        lut = self.lut()
+        if numpy is not None:
+            c = numpy.frombuffer(rgb, dtype=numpy.uint8).reshape(-1, 3) >> 3
+            k = (c[:, 0].astype(numpy.int32) << 10) \
+                | (c[:, 1].astype(numpy.int32) << 5) | c[:, 2]
+            return numpy.frombuffer(lut, dtype=numpy.uint8)[k].tobytes()
+        index = self.index
+        return bytes( index(rgb[i : i+3]) for i in range(0, len(rgb), 3) )
+
+
+# return the lookup table cell of colour r,g,b
+def cell(r, g, b):
+    return ((r>>3)<<10) | ((g>>3)<<5) | (b>>3)
+
+
+# 6x6x6 colour cube and 40 greys
+def default_colours():
+    levels = (0, 51, 102, 153, 204, 255)
+    colours = [ (r, g, b) for r in levels for g in levels for b in levels ]
+    colours += [ (v, v, v) for v in range(6, 246, 6) ]
+    return colours
+
+
+class PixelFormat():
+
+    # max. colours cached by pack()
+    cache_size = 1024
+
+    # colours of all pixel formats that are not true-colour, the
+    # default built when first needed (refer server_palette())
+    palette = None
+
+    # pixel format compiled once, packs (r,g,b) colours to pixel bytes,
+    # as the index of the nearest palette colour if not true-colour
+    def __init__(self, bpp, depth, big, true, masks, shifts, palette=None):
+        self.bpp = bpp
+        self.depth = depth
+        self.big = big
+        self.true = true
+        self.masks = masks
+        self.shifts = shifts
+        self.palette = palette
+        self.key = (bpp, depth, big, true, masks, shifts, palette)
+        self.bytespp = bpp//8
+        self._fmt = ('>' if big else '<') + \
+                    ('L' if bpp==32 else ('H' if bpp==16 else 'B'))
+        self._cache = {}
+        self._offsets = self.offsets()
+
+    # return the byte offset, within a pixel, of each colour channel
+    # if every channel is a whole byte, else None
+    def offsets(self):
+        if not self.true:
+            return None
+        offsets = []
+        for mask, shift in zip(self.masks, self.shifts):
+            if mask != 255 or shift%8 or shift//8 >= self.bytespp:
+                return None
+            offsets.append(
+                self.bytespp-1-(shift//8) if self.big else shift//8
+            )
+        return offsets
+
+    # pack colour (r,g,b), 8 bits per channel, each channel scaled to
+    # its mask (the channel's max. value)
+    def pack(self, colour):
+        try:
+            b = self._cache.get(colour)
+        except TypeError: # unhashable e.g. list
+            colour = tuple(colour)
+            b = self._cache.get(colour)
+        if b is None:
+            b = self.pixel(colour)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[colour] = b
+        return b
+
+    # return the pixel bytes of colour (r,g,b), not cached
+    def pixel(self, colour):
+        if not self.true:
+            return pack(self._fmt, self.palette.index(colour))
+        v = 0
+        for channel, mask, shift in zip(colour, self.masks, self.shifts):
+            v += (channel*mask//255)<<shift
+        return pack(self._fmt, v)
+
+    # return buffer of packed (r,g,b) bytes converted to pixel bytes
+    def convert(self, rgb):
+        n = len(rgb)//3
+        if not self.true:
+            indices = self.palette.indices(rgb)
+            if self.bytespp == 1:
+                return indices
+            return b''.join( pack(self._fmt, i) for i in indices )
+        if self._offsets is not None:
+            out = bytearray(n*self.bytespp)
+            try:
+                for channel, offset in enumerate(self._offsets):
+                    out[offset::self.bytespp] = rgb[channel::3]
+                return out
+            except: # no extended slice assignment (micropython)
+                pass
+        cache = {}
+        b = []
+        for i in range(0, n*3, 3):
+            colour = bytes(rgb[i : i+3])
+            p = cache.get(colour)
+            if p is None:
+                p = cache[colour] = self.pixel(colour)
+            b.append(p)
+        return b''.join(b)
+
+
+# pixel formats by key, shared by all sessions and rectangles
+_formats = {}
+
+# return PixelFormat.palette, built as the default colours the first
+# time a pixel format that is not true-colour needs it, so servers with
+# only true-colour clients never build it
+def server_palette():
+    if PixelFormat.palette is None:
+        PixelFormat.palette = Palette( default_colours() )
+    return PixelFormat.palette
+
+# return the key of a pixel format, including the palette in use if
+# not true-colour
+def pixelformat_key(bpp, depth, big, true, masks, shifts):
+    return (bpp, depth, big, true, masks, shifts,
+            None if true else server_palette())
+
+def get_pixelformat(bpp, depth, big, true, masks, shifts):
+    key = pixelformat_key(bpp, depth, big, true, masks, shifts)
+    pf = _formats.get(key)
+    if pf is None:
+        if len(_formats) >= 16:
+            _formats.clear()
+        pf = _formats[key] = PixelFormat(*key)
+    return pf
@@ -13,30 +13,52 @@ def ServerSetPixelFormat(bpp, depth, big, true, masks, shifts):
            ) + bytes(3) # pad to 16 bytes
 
 
+# count 0xFFFF if the rectangles following are ended by a LastRect
+def ServerFrameBufferUpdateHeader(count=0xFFFF):
+    return b'\x00\x00' + pack('>H', count)
+
+
+# return list of buffers (header, rectangle headers and pixels) to be
+# sent by RfbSession.send() without concatenation
 def ServerFrameBufferUpdate(rectangles):
     if rectangles: # empty list is False
-        buffer = bytes()
-        for idx,rect in enumerate( rectangles ):
-            b = rect.to_bytes()
+        buffers = [None] # header
+        keep = []
+        count = 0
+        for rect in rectangles:
+            b = rect.to_buffers()
             if b is None: # done with this rectangle
-                del( rectangles[idx] ) 
-            elif b is False:
-                pass # no update required
-            else:
-                buffer += b
-        return b'\x00\x00' \
-                + pack('>H', len(rectangles)) \
-                + buffer
-
-
-# # colourmap not implemented
-# def ServerSetColourMapEntries(colourmap):
-#     b = b''
-#     for colour in colourmap:
-#         b += pack('>3H', colour[0], colour[1], colour[2])
-#     return v'\x01\x00' \
-#            + pack('>2H', 0, len(colourmap)) \
-#            + b
+                continue
+            keep.append(rect)
+            if b is not False: # False = no update required
+                buffers.extend(b)
+                count += 1
+        rectangles[:] = keep
+        if count:
+            buffers[0] = ServerFrameBufferUpdateHeader(count)
+            return buffers
+
+
+# colours (r,g,b) of 8 bits per channel, from colour map index first
+def ServerSetColourMapEntries(first, colours):
+    return pack('>BxHH', 1, first, len(colours)) \
+           + b''.join(
+                 pack('>3H', r*257, g*257, b*257) for r, g, b in colours
+             )
+
+
+def ServerEndOfContinuousUpdates():
+    return b'\x96'
+
+
+# Fence flags
+FENCE_BLOCK_BEFORE = 1
+FENCE_BLOCK_AFTER = 2
+FENCE_SYNC_NEXT = 4
+FENCE_REQUEST = 0x80000000
+
+def ServerFence(flags, payload=b''):
+    return pack('>B3xLB', 248, flags, len(payload)) + payload
 
 
 def ServerBell():
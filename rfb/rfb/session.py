@@ -1,24 +1,102 @@
 try:
     # micropython
-    from utime import sleep_ms
+    from utime import sleep_ms, ticks_ms, ticks_diff
 except:
-    from time import sleep
+    from time import sleep, monotonic
     def sleep_ms(t):
         sleep(t/1000)
+    def ticks_ms():
+        return int(monotonic()*1000)
+    def ticks_diff(a, b):
+        return a-b
 
 try:
     from ustruct import pack
 except:
     from struct import pack
 
-from rfb.clientmsgs import dispatch_msgs
-from rfb.servermsgs import ServerSetPixelFormat
+try: # cpython, accepted sockets are blocking
+    from socket import MSG_DONTWAIT, SOL_SOCKET, SO_SNDBUF
+except:
+    MSG_DONTWAIT = None
+
+try:
+    from uerrno import EAGAIN
+except:
+    from errno import EAGAIN
+
+from rfb.clientmsgs import dispatch_msgs, InputQueue
+from rfb.servermsgs import ServerSetPixelFormat, ServerFrameBufferUpdate, \
+                           ServerFrameBufferUpdateHeader, \
+                           ServerSetColourMapEntries, \
+                           ServerEndOfContinuousUpdates, ServerFence, \
+                           FENCE_REQUEST, FENCE_BLOCK_BEFORE, FENCE_BLOCK_AFTER
+from rfb.damage import Damage, bounds, optimise, split
+from rfb.pixelformat import get_pixelformat, pixelformat_key
+from rfb.encodings import RAWRECT, RRERECT, CORRE, HEXTILE, ZRLE, \
+                          LAST_RECT, CURSOR, FENCE, CONTINUOUS_UPDATES, \
+                          CopyRect, CursorRect, LastRect, EncodedRect, RawRect, AutoRRERect, CoRRERect, \
+                          HextileRect, ZRLERect, zlib
 
 class RfbSession():
 
+    # if True framebuffer damage is only sent in reply to a client
+    # FrameBufferUpdateRequest, and only where it intersects the
+    # requested region
+    on_request = False
+
+    # if True key and pointer events are queued, and delivered once per
+    # server tick by service_input(), with pointer moves merged
+    coalesce_input = False
+
+    # max. frames per second, update() is called at most this often by
+    # the server; 0 for every server tick
+    fps = 0
+    # min. ms the socket is backlogged to measure throughput
+    measure_ms = 100
+
+    # (x, y, w, h, pixels, mask) of the cursor drawn by the client, if
+    # it supports the Cursor pseudo-encoding (refer set_cursor())
+    cursor = None
+
+    # max. updates pushed, once the client has enabled continuous
+    # updates, ahead of its response to the fence following each
+    fence_window = 2
+
+    # if True damage is merged and split, by the estimated cost of
+    # sending it in the session's encoding, before it is sent
+    optimise_damage = True
+
+    # encodings framebuffer updates can be sent in, the first listed
+    # in the client's (order of preference) encodings is used
+    encoders = {
+        HEXTILE: HextileRect,
+        CORRE: CoRRERect,
+        RRERECT: AutoRRERect,
+        RAWRECT: RawRect,
+    }
+    if zlib:
+        encoders[ZRLE] = ZRLERect
+
     # on fail raise; to prevent invalid session at parent
+    # conn is as returned by socket.accept(), and the handshake blocks,
+    # or a completed RfbHandshake (as created by RfbServer)
     def __init__(self, conn, w, h, name):
+        if isinstance(conn, RfbHandshake):
+            self.conn, self.addr = conn.conn, conn.addr
+            self.setup(w, h, name)
+            self._out, self.pending = conn._out, conn.pending
+            # messages received since ServerInit
+            self.buffer_msgs(conn.buffer)
+            if not self.dispatch():
+                raise RfbSessionRejected('client message')
+            return
         self.conn, self.addr = conn
+        self.setup(w, h, name)
+        self.handshake()
+
+    # session state, set before the handshake
+    def setup(self, w, h, name):
         self.w = w
         self.h = h
         self.bpp = 32
@@ -31,7 +109,50 @@ class RfbSession():
         self.name = name
         self._security = 1 # None/No Security
         self.encodings = [] # sent post init by client
+        # shared server framebuffer, set by FrameBuffer.attach()
+        self.framebuffer = None
+        # regions of framebuffer not yet sent to client
+        self.damage = Damage()
+        # regions moved (x, y, w, h, src_x, src_y), not yet sent as
+        # CopyRect, by framebuffer move detection
+        self.moves = []
+        # pending FrameBufferUpdateRequest region (x, y, w, h)
+        self.request = None
+        # continuous updates region (x, y, w, h), if enabled by client
+        self.continuous = None
+        # fence requests sent, not yet answered by the client
+        self.fences = 0
+        # pseudo-encodings whose support has been announced
+        self.announced = []
+        # (cursor, pixel format key) as last sent
+        self._cursor_sent = None
+        # Palette sent to the client, cleared when the client sets
+        # its pixel format
+        self.colourmap = None
+        # ZRLE compressor, one stream for the lifetime of the session
+        self._zstream = None
+        self._pixelformat = None
+        # received client messages not yet dispatched
+        self._msgs = bytearray(self.recv_buffer_size)
+        self._msgs_len = 0
+        # key and pointer events not yet delivered, if coalesce_input
+        self.input_queue = InputQueue() if self.coalesce_input else None
+        # buffers not yet accepted by the socket, and their length
+        self._out = []
+        self.pending = 0
+        # bytes per second the client's connection carries, measured
+        # while the socket is backlogged (refer backlogged()), else None
+        self.throughput = None
+        # bytes accepted by the socket
+        self._sent = 0
+        # (ms, bytes accepted) when the socket was first found full,
+        # while backlogged
+        self._full = None
+        # when bytes accepted by the socket are estimated to have been
+        # carried to the client, once throughput is known
+        self._frame_ms = self._carried_ms = ticks_ms()
 
+    def handshake(self):
         # HandShake
         self.send( b'RFB 003.003\n' )
         if self.recv(True) != b'RFB 003.003\n':
@@ -44,32 +165,50 @@ class RfbSession():
             raise RfbSessionRejected('no security')
 
         # ServerInit
-        self.send(
-            pack('>2H', w, h) \
-            + ServerSetPixelFormat(
-                self.bpp, self.depth, 
-                self.big, self.true,
-                self.masks, self.shifts
-            ) \
-            + pack('>L', len(name)) \
-            + name
-        )
+        self.send( self.server_init() )
 
         # we *may* be sent encodings and pixel format
         # we *must* process these messages before
         # sending any rectangles, otherwise we don't
         # know what encodings or pixel format client
         # accepts
-        self.service_msg_queue()
+        if not self.service_msg_queue(True):
+            raise RfbSessionRejected('client message')
 
-        # send colourmap (not currently supported)
-        # must be sent after receiving pixel format
-        # any sent earlier ignorred by client
+    def server_init(self):
+        return pack('>2H', self.w, self.h) \
+               + ServerSetPixelFormat(
+                   self.bpp, self.depth, 
+                   self.big, self.true,
+                   self.masks, self.shifts
+               ) \
+               + pack('>L', len(self.name)) \
+               + self.name
     
     @property
     def security(self):
         return self._security
 
+    # compiled pixel format, rebuilt when the client changes format
+    # (or the palette is changed)
+    @property
+    def pixelformat(self):
+        key = pixelformat_key(self.bpp, self.depth, self.big, self.true,
+                              self.masks, self.shifts)
+        if self._pixelformat is None or self._pixelformat.key != key:
+            self._pixelformat = get_pixelformat(*key[:6])
+        return self._pixelformat
+
+    @property
+    def zstream(self):
+        if self._zstream is None:
+            self._zstream = zlib.compressobj()
+        return self._zstream
+
+    # ms recv() waits before a non-blocking read, set to 0 by servers
+    # that only read when the socket is readable
+    recv_delay = 1
+
     def recv(self, blocking=False):
         while blocking:
             # init fails at peer without this blocking delay
@@ -79,26 +218,493 @@ class RfbSession():
                 return r
         try:
             # main loops fail at peer without this blocking delay ...
-            sleep_ms(1) 
+            if self.recv_delay:
+                sleep_ms(self.recv_delay)
+            if MSG_DONTWAIT:
+                return self.conn.recv(1024, MSG_DONTWAIT)
             return self.conn.recv(1024)
-        except:
-            pass
+        except OSError as e:
+            # nothing to read, else connection is lost
+            if e.args and e.args[0] == EAGAIN:
+                return None
+            return b''
 
+    # initial size of the client message buffer, grown to hold longer
+    # messages (i.e. ClientCutText)
+    recv_buffer_size = 4096
+    # max. length of a client message, a longer one closes the session
+    # (the longest SetEncodings is 262144 bytes)
+    recv_buffer_max = 262144
+
+    # read into the client message buffer, return the number of bytes
+    # read, 0 if closed by peer, or None if there is nothing to read
+    def recv_into(self, blocking=False):
+        if blocking or not hasattr(self.conn, 'recv_into'): # micropython
+            msg = self.recv(blocking)
+            if msg:
+                self.buffer_msgs(msg)
+            return None if msg is None else len(msg)
+        if len(self._msgs)-self._msgs_len < self.recv_buffer_size//4:
+            self._msgs.extend( bytes(len(self._msgs)) )
+        try:
+            if self.recv_delay:
+                sleep_ms(self.recv_delay)
+            n = self.conn.recv_into(
+                    memoryview(self._msgs)[self._msgs_len:],
+                    0, MSG_DONTWAIT or 0
+                )
+        except OSError as e:
+            # nothing to read, else connection is lost
+            if e.args and e.args[0] == EAGAIN:
+                return None
+            return 0
+        self._msgs_len += n
+        return n
+
+    # append received bytes to the client message buffer
+    def buffer_msgs(self, b):
+        end = self._msgs_len + len(b)
+        if end > len(self._msgs):
+            self._msgs.extend( bytes(end-len(self._msgs)) )
+        self._msgs[self._msgs_len : end] = b
+        self._msgs_len = end
+
+    # dispatch complete messages buffered, an incomplete message is
+    # moved to the start of the buffer until the rest is received;
+    # False if a message is unknown or too long (refer dispatch_msgs())
+    def dispatch(self):
+        used = dispatch_msgs(self, memoryview(self._msgs)[:self._msgs_len])
+        if used is None:
+            self._msgs_len = 0
+            return False
+        if used:
+            self._msgs_len -= used
+            self._msgs[:self._msgs_len] = \
+                self._msgs[used : used+self._msgs_len]
+        if not self._msgs_len and len(self._msgs) > self.recv_buffer_size:
+            # release a buffer grown for a long message
+            self._msgs = bytearray(self.recv_buffer_size)
+        return True
+
+    # max. buffers per sendmsg() call (IOV_MAX)
+    iov_max = 1024
+
+    # b is bytes, or a list of bytes-like buffers (e.g. as returned by
+    # ServerFrameBufferUpdate) sent by scatter/gather where supported;
+    # what the socket won't accept without blocking is queued (pending
+    # bytes) and sent by flush()
     def send(self, b):
-        if b: # None and b'' are False
-            self.conn.send(b)
+        if not b: # None and b'' are False
+            return
+        if type(b) is not list:
+            b = [b]
+        if MSG_DONTWAIT is None: # micropython, sent blocking
+            for buffer in b:
+                self.conn.send(buffer)
+            return
+        self._out.extend(b)
+        self.pending += sum( len(buffer) for buffer in b )
+        if self.flush():
+            # buffers not yet sent may be drawn again (e.g. a RawRect
+            # of the application) before the socket drains, those not
+            # immutable are copied
+            self._out[:] = [ buffer if type(buffer) is bytes
+                             or type(buffer) is memoryview
+                                and type(buffer.obj) is bytes
+                             else bytes(buffer) for buffer in self._out ]
 
-    def service_msg_queue(self):
-        msg = self.recv()
+    # send queued buffers the socket accepts without blocking, return
+    # the bytes still pending
+    def flush(self):
+        out = self._out
+        while out:
+            try:
+                if hasattr(self.conn, 'sendmsg'):
+                    sent = self.conn.sendmsg(
+                               out[:self.iov_max], (), MSG_DONTWAIT
+                           )
+                else:
+                    sent = self.conn.send(out[0], MSG_DONTWAIT)
+            except OSError as e:
+                if e.args[0] == EAGAIN: # socket buffer full
+                    self.backlogged()
+                    break
+                raise
+            self.pending -= sent
+            self._sent += sent
+            self.carried(sent)
+            # skip buffers sent, and any part sent of the next
+            i = 0
+            while i < len(out) and sent >= len(out[i]):
+                sent -= len(out[i])
+                i += 1
+            del out[:i]
+            if sent:
+                out[0] = memoryview(out[0])[sent:]
+        if not out:
+            self._full = None
+        return self.pending
 
-        if msg == b'': #closed by peer
+    # bytes the socket buffers, when full
+    def sndbuf(self):
+        try:
+            return self.conn.getsockopt(SOL_SOCKET, SO_SNDBUF)
+        except:
+            return 0
+
+    # the socket buffer is full: bytes accepted since it was first
+    # found full, while still backlogged, are those the connection has
+    # carried meanwhile (the buffer being full at both times), which
+    # measures throughput; the socket now holds a buffer full of bytes
+    # not yet carried
+    def backlogged(self):
+        now = ticks_ms()
+        if self._full is None:
+            self._full = (now, self._sent)
+        else:
+            ms = ticks_diff(now, self._full[0])
+            if ms >= self.measure_ms:
+                self.throughput = ((self._sent-self._full[1])*1000)//ms
+        self.carried(self.sndbuf(), True)
+
+    # add n bytes accepted by the socket to those not yet carried to
+    # the client, at the measured throughput; if full, the socket holds
+    # n bytes not yet carried
+    def carried(self, n, full=False):
+        if not self.throughput:
+            return
+        now = ticks_ms()
+        if full:
+            ms = (n*1000) // self.throughput
+            if ticks_diff(now+ms, self._carried_ms) > 0:
+                self._carried_ms = now+ms
+            return
+        # an eighth faster than measured, so the socket backs up (and
+        # throughput is measured again) if the connection is faster
+        ms = (n*1000) // (self.throughput + self.throughput//8)
+        if ticks_diff(now, self._carried_ms) > 0:
+            self._carried_ms = now+ms
+        else:
+            self._carried_ms += ms
+
+    # True if the client is ready for a frame, called by the server
+    # before update(): the last frame has been accepted by the socket
+    # (otherwise the frame is skipped, damage accumulating until the
+    # client catches up), and the bytes the socket has accepted have
+    # been carried to the client at the measured throughput (frames are
+    # paced to the connection, rather than latency building up in the
+    # socket buffer), and if fps is set a frame interval has passed
+    def ready(self):
+        now = ticks_ms()
+        if self.flush() or self.fences >= self.fence_window:
             return False
-        elif msg is not None:
-            dispatch_msgs(self, msg)
+        if ticks_diff(self._carried_ms, now) > 0:
+            return False
+        if self.fps:
+            if ticks_diff(now, self._frame_ms) < 1000//self.fps:
+                return False
+            self._frame_ms = now
+        self.send_colourmap()
+        return True
+
+    # send the palette if the session's pixel format isn't true-colour,
+    # before any rectangles, and again (with the whole framebuffer) if
+    # the palette has changed
+    def send_colourmap(self):
+        if self.true:
+            return
+        palette = self.pixelformat.palette
+        if self.colourmap is palette:
+            return
+        if self.colourmap is not None and self.framebuffer is not None:
+            # pixels the client has are of the previous palette
+            self.damage.add(0, 0, self.w, self.h)
+        self.send( ServerSetColourMapEntries(0, palette.colours) )
+        self.colourmap = palette
+
+    # deliver queued key and pointer events, called by the server before
+    # update() when coalesce_input is True
+    def service_input(self):
+        if self.input_queue:
+            self.input_queue.deliver(self)
+
+    # default update sends framebuffer damage, sub-classes sending
+    # their own rectangles over-ride this
+    def update(self):
+        self.send_damage()
+
+    def send_damage(self):
+        self.send_colourmap()
+        cursor = self.cursor_pending()
+        if not (cursor or self.framebuffer is not None
+                          and (self.damage or self.moves)):
+            return
+        if self.on_request or self.continuous:
+            # continuous updates are a standing request
+            region = self.request
+            if self.continuous is not None:
+                region = self.continuous if region is None \
+                         else bounds( (region, self.continuous) )
+            if region is None:
+                return
+            rects = self.damage.pop(region)
+            if not (rects or self.moves or cursor):
+                # request stays pending until damage intersects it
+                return
+            self.request = None
+        else:
+            rects = self.damage.pop()
+        if self.framebuffer is None:
+            rects = []
+        # moves first, they copy from the client's current framebuffer
+        moves = [ CopyRect.get(*m) for m in self.moves ]
+        if cursor:
+            moves.insert(0, self.cursor_rect())
+        self.moves = []
+        encoder = self.encoder()
+        if self.optimise_damage:
+            rect_cost, pixel_cost = self.cost(encoder)
+            rects = optimise(rects, rect_cost, pixel_cost)
+            # damage accumulated before the next update is reduced
+            # at the same cost
+            self.damage.rect_cost = rect_cost
+            self.damage.pixel_cost = pixel_cost
+        if LAST_RECT in self.encodings and len(rects) > 1:
+            self.send_streamed(moves, rects, encoder)
+        else:
+            update = moves + self.encode_regions(rects, encoder)
+            self.send( ServerFrameBufferUpdate(update) )
+            # sent, or queued as buffers
+            for rect in update:
+                rect.release()
+        if self.continuous is not None and FENCE in self.encodings:
+            # the client's response paces continuous updates
+            self.fence()
+
+    # send an update of rectangles, then regions x,y,w,h each encoded as
+    # it is sent; the client must support the LastRect pseudo-encoding,
+    # as the rectangles are not counted, so only one region is held
+    # encoded at a time and the first is sent before the rest are encoded
+    def send_streamed(self, rectangles, regions, encoder=None):
+        self.send( ServerFrameBufferUpdateHeader() )
+        for rect in rectangles:
+            self.send( rect.to_buffers() )
+            rect.release()
+        for r in regions:
+            for rect in self.encode_regions([r], encoder):
+                self.send( rect.to_buffers() )
+                rect.release()
+        self.send( LastRect().to_bytes() )
+
+    # set the cursor the client draws locally at the pointer position,
+    # sent with the next update if the client supports the Cursor
+    # pseudo-encoding; x,y is the hotspot, pixels are w*h packed (r,g,b)
+    # bytes and mask is w*h bits, rows padded to whole bytes, 1 where the
+    # cursor is drawn (e.g. Font.getbitmap_bytes() of an 8 pixel wide font)
+    def set_cursor(self, x, y, w, h, pixels, mask):
+        self.cursor = (x, y, w, h, bytes(pixels), bytes(mask))
+
+    # True if the cursor has not been sent in the session's pixel format
+    def cursor_pending(self):
+        return self.cursor is not None and CURSOR in self.encodings \
+               and self._cursor_sent != (self.cursor, self.pixelformat.key)
+
+    # return the cursor as a CursorRect in the session's pixel format
+    def cursor_rect(self):
+        x, y, w, h, pixels, mask = self.cursor
+        rect = CursorRect(
+                   x, y, w, h,
+                   self.bpp, self.depth,
+                   self.big, self.true,
+                   self.masks, self.shifts,
+                   mask
+               )
+        rect.buffer[:] = self.pixelformat.convert(pixels)
+        self._cursor_sent = (self.cursor, self.pixelformat.key)
+        return rect
+
+    # send a fence request, the client responds once it has processed
+    # everything sent before it
+    def fence(self, flags=FENCE_BLOCK_BEFORE, payload=b''):
+        self.send( ServerFence(flags | FENCE_REQUEST, payload) )
+        self.fences += 1
+
+    # may be received during init; support for the extensions listed
+    # is announced once, sub-classes over-riding this must call it
+    def ClientSetEncodings(self, encodings):
+        for encoding in (CONTINUOUS_UPDATES, FENCE):
+            if encoding in encodings and encoding not in self.announced:
+                self.announced.append(encoding)
+                if encoding == FENCE:
+                    self.fence()
+                else:
+                    self.send( ServerEndOfContinuousUpdates() )
+
+    def ClientEnableContinuousUpdates(self, enable, x, y, w, h):
+        if enable:
+            self.continuous = (x, y, w, h)
+        else:
+            self.continuous = None
+            self.send( ServerEndOfContinuousUpdates() )
+
+    def ClientFence(self, flags, payload):
+        if flags & FENCE_REQUEST:
+            # messages are dispatched, and replies sent, in order;
+            # SyncNext is not supported
+            self.send( ServerFence(
+                flags & (FENCE_BLOCK_BEFORE | FENCE_BLOCK_AFTER), payload
+            ) )
+        elif self.fences:
+            self.fences -= 1
+
+    # may be received during init, before the framebuffer is attached
+    def ClientFrameBufferUpdateRequest(self, incr, x, y, w, h):
+        if not incr:
+            # client has lost (or never had) the region's content
+            self.damage.add(x, y, min(w, self.w-x), min(h, self.h-y))
+        if self.request is None:
+            self.request = (x, y, w, h)
+        else:
+            self.request = bounds( (self.request, (x, y, w, h)) )
+
+    # return the rectangle class for framebuffer updates
+    def encoder(self):
+        for encoding in self.encodings:
+            if encoding in self.encoders:
+                return self.encoders[encoding]
+        return RawRect
+
+    # return estimated (bytes per rectangle, bytes per pixel) of sending
+    # framebuffer regions with encoder, in the session's pixel format
+    def cost(self, encoder=None):
+        encoder = encoder or self.encoder()
+        return encoder.cost_rect, \
+               encoder.cost_pixel*self.pixelformat.bytespp
+
+    # return a rectangle encoding framebuffer region x,y,w,h, shared
+    # with other sessions in the same pixel format and encoding
+    # (refer FrameBuffer.cache)
+    def encode(self, x, y, w, h, encoder=None):
+        encoder = encoder or self.encoder()
+        if encoder is CoRRERect and (w > 255 or h > 255):
+            # only encodings the client supports may be sent
+            encoder = AutoRRERect if RRERECT in self.encodings else RawRect
+        fb = self.framebuffer
+        key = fb.cache_key(x, y, w, h, self.pixelformat, encoder)
+        if key is not None:
+            buffers = fb.cache.get(key)
+            if buffers is not None:
+                return EncodedRect.get(x, y, w, h, encoder.encoding, buffers)
+        rect = fb.rect(
+                    x, y, w, h,
+                    self.bpp, self.depth,
+                    self.big, self.true,
+                    self.masks, self.shifts,
+                    encoder
+               )
+        if rect.encoding == ZRLE:
+            rect.zstream = self.zstream
+        if key is not None:
+            buffers = rect.to_buffers()
+            if buffers:
+                fb.cache_add(key, buffers)
+                rect.release()
+                return EncodedRect.get(x, y, w, h, encoder.encoding, buffers)
+        return rect
+
+    # return rectangles encoding regions x,y,w,h, in order, CoRRE
+    # regions split to fit its 255 pixel limit
+    def encode_regions(self, regions, encoder=None):
+        encoder = encoder or self.encoder()
+        if encoder is CoRRERect:
+            # w and h must be less than 256
+            regions = [ t for r in regions for t in split(r, 255) ]
+        return [ self.encode(*r, encoder=encoder) for r in regions ]
+
+    def service_msg_queue(self, blocking=False):
+        n = self.recv_into(blocking)
+
+        if n == 0: #closed by peer
+            return False
+        elif n is not None:
+            return self.dispatch()
 
         return True
 
 
+# the session handshake as a state machine advanced, without blocking,
+# as bytes are received; complete once client messages following
+# ServerInit (normally pixel format and encodings) have been received,
+# then passed as conn to the session handler
+class RfbHandshake(RfbSession):
+
+    VERSION = 0
+    SECURITY = 1
+    INIT = 2
+    DONE = 3
+
+    # ms without bytes received before the handshake expires
+    timeout_ms = 10000
+
+    def __init__(self, conn, w, h, name):
+        self.conn, self.addr = conn
+        self.setup(w, h, name)
+        self.buffer = b''
+        self.state = self.VERSION
+        self._received_ms = ticks_ms()
+        self.send( b'RFB 003.003\n' )
+
+    # True if the peer has stalled (refer timeout_ms)
+    def expired(self):
+        return ticks_diff(ticks_ms(), self._received_ms) >= self.timeout_ms
+
+    # read any bytes available and advance, return True when complete,
+    # on fail raise RfbSessionRejected
+    def advance(self):
+        msg = self.recv()
+        if msg == b'':
+            raise RfbSessionRejected('closed by peer')
+        elif msg is not None:
+            self.buffer += msg
+            self._received_ms = ticks_ms()
+
+        if self.state == self.VERSION and len(self.buffer) >= 12:
+            if self.buffer[:12] != b'RFB 003.003\n':
+                raise RfbSessionRejected('version proposal')
+            self.buffer = self.buffer[12:]
+            self.send( pack('>L', self.security) )
+            self.state = self.SECURITY
+
+        if self.state == self.SECURITY and len(self.buffer) >= 1:
+            # ignore instruction to disconnect other clients
+            if self.buffer[0] not in (0,1):
+                raise RfbSessionRejected('no security')
+            self.buffer = self.buffer[1:]
+            self.send( self.server_init() )
+            self.state = self.INIT
+
+        if self.state == self.INIT and encodings_known(self.buffer):
+            self.state = self.DONE
+
+        return self.state == self.DONE
+
+
+# True once the messages b, following ServerInit, include the client's
+# encodings (or a FrameBufferUpdateRequest, sent without them), so the
+# first update is sent in the client's encoding
+def encodings_known(b):
+    p = 0
+    while p < len(b):
+        if b[p] == 0: # SetPixelFormat
+            p += 20
+        elif b[p] == 2: # SetEncodings
+            return len(b) >= p+4 \
+                   and len(b) >= p+4+4*((b[p+2]<<8) | b[p+3])
+        else: # FrameBufferUpdateRequest, or any other message
+            return True
+    return False
+
+
 class RfbSessionRejected(Exception):
     pass
 
@@ -0,0 +1,52 @@
+import rfb
+
+try:
+    # wipy port
+    from os import urandom
+    def rand():
+        return urandom(1)[0]
+except:
+    try:
+        # unix port
+        from urandom import getrandbits
+        def rand():
+            return getrandbits(8)
+    except:
+        # cpython
+        from random import getrandbits
+        def rand():
+            return getrandbits(8)
+
+w, h = 255, 255
+size = 30
+
+
+class SharedBounce(rfb.RfbServer):
+
+    # square bounced around the shared framebuffer, drawn once per
+    # loop irrespective of the number of connected sessions
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.x, self.y = w//2, h//2
+        self.vector = [rand()//60+1, rand()//60+1]
+        self.colour = (rand(), rand(), rand())
+        self.framebuffer.fill((0,0,0))
+
+    def update(self):
+        if not self.sessions:
+            return
+        # clear previous position
+        self.framebuffer.fill_rect(self.x, self.y, size, size, (0,0,0))
+        if not 0 <= self.x+self.vector[0] <= w-size:
+            self.vector[0] = -self.vector[0]
+            self.colour = (rand(), rand(), rand())
+        if not 0 <= self.y+self.vector[1] <= h-size:
+            self.vector[1] = -self.vector[1]
+            self.colour = (rand(), rand(), rand())
+        self.x += self.vector[0]
+        self.y += self.vector[1]
+        self.framebuffer.fill_rect(self.x, self.y, size, size, self.colour)
+
+
+svr = SharedBounce(w, h, name=b'shared', framebuffer=True)
+svr.serve()
\ No newline at end of file
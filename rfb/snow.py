@@ -19,6 +19,11 @@ except:
             return getrandbits(8)
 
 
+# rectangles have no __dict__, attributes must be declared
+class Flake(rfb.RRERect):
+    __slots__ = ('vector',)
+
+
 class Snow(rfb.RfbSession):
 
     def __init__(self, conn, w, h, name):
@@ -30,8 +35,9 @@ class Snow(rfb.RfbSession):
         # update existing flakes
         for idx, flake in enumerate(self.snowflakes):
             if flake.y + flake.h + flake.vector >= 255:
-                # delete flakes that have settled
+                # delete flakes that have settled, for re-use
                 del( self.snowflakes[idx] )
+                flake.release()
             else:
                 flake.y += flake.vector
 
@@ -42,7 +48,7 @@ class Snow(rfb.RfbSession):
             x = x if x<self.w-size else x-size
             vector = 3-size
             self.snowflakes.append(
-                rfb.RRERect(
+                Flake.get(
                     x, 0, 
                     size, size+vector,
                     (0,0,0),
@@ -53,7 +59,7 @@ class Snow(rfb.RfbSession):
             )
             self.snowflakes[-1].vector = vector
             self.snowflakes[-1].subrectangles.append(
-                rfb.RRESubRect(
+                rfb.RRESubRect.get(
                     0, vector,
                     size, size,
                     (255,255,255),
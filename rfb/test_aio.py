@@ -0,0 +1,151 @@
+# AsyncRfbServer connections, run as a script or with pytest (cpython)
+import asyncio
+import rfb
+from struct import pack, unpack
+
+
+def set_encodings(encodings):
+    return pack('>BxH', 2, len(encodings)) \
+           + b''.join( pack('>l', e) for e in encodings )
+
+# start a server on a free port
+async def server(**kwargs):
+    svr = rfb.AsyncRfbServer(64, 48, addr=('127.0.0.1', 0), **kwargs)
+    await svr.start()
+    svr.port = svr.server.sockets[0].getsockname()[1]
+    return svr
+
+# connect, returning the client streams once ServerInit has been received
+async def init(svr):
+    reader, writer = await asyncio.open_connection('127.0.0.1', svr.port)
+    assert await reader.readexactly(12) == b'RFB 003.003\n'
+    writer.write(b'RFB 003.003\n')
+    await reader.readexactly(4)
+    writer.write(b'\x01')
+    n = (await reader.readexactly(24))[-4:]
+    await reader.readexactly(int.from_bytes(n, 'big'))
+    return reader, writer
+
+def run(test):
+    asyncio.run( asyncio.wait_for(test(), 5) )
+
+
+# the handshake completes once the client's encodings are received, in
+# however many parts, and the first update is sent in that encoding
+def test_first_update_in_client_encoding():
+    async def test():
+        svr = await server(framebuffer=True)
+        reader, writer = await init(svr)
+        b = set_encodings( (rfb.HEXTILE, rfb.RAWRECT) )
+        writer.write(b[:6])
+        await asyncio.sleep(0.1)
+        assert not svr.sessions
+        writer.write(b[6:])
+        header = await reader.readexactly(4+12)
+        assert header[0] == 0
+        assert unpack('>l', header[-4:])[0] == rfb.HEXTILE
+        writer.close()
+        await svr.shutdown()
+    run(test)
+
+# a client that stalls during the handshake is closed
+def test_stalled_handshake_closed():
+    async def test():
+        timeout_ms = rfb.AsyncRfbSession.timeout_ms
+        rfb.AsyncRfbSession.timeout_ms = 100
+        try:
+            svr = await server()
+            reader, writer = await init(svr)
+            assert await reader.read(1) == b''
+            assert not svr.sessions
+        finally:
+            rfb.AsyncRfbSession.timeout_ms = timeout_ms
+        writer.close()
+        await svr.shutdown()
+    run(test)
+
+# cancelling serve() closes every session, and those yet to complete
+# the handshake, without logging the cancellation of their tasks
+def test_cancelled_serve_closes_sessions():
+    async def test():
+        svr = rfb.AsyncRfbServer(64, 48, addr=('127.0.0.1', 0))
+        serve = asyncio.ensure_future(svr.serve())
+        await asyncio.sleep(0.1)
+        svr.port = svr.server.sockets[0].getsockname()[1]
+        reader, writer = await init(svr)
+        writer.write( set_encodings((0,)) )
+        pending = await asyncio.open_connection('127.0.0.1', svr.port)
+        while not svr.sessions:
+            await asyncio.sleep(0.01)
+        serve.cancel()
+        try:
+            await serve
+        except asyncio.CancelledError:
+            pass
+        assert not svr.sessions and not svr._tasks
+        for r in (reader, pending[0]):
+            while await r.read(4096):
+                pass
+        writer.close()
+        pending[1].close()
+    errors = []
+    def handler(loop, context):
+        errors.append(context)
+    async def test_logged():
+        asyncio.get_running_loop().set_exception_handler(handler)
+        await test()
+        await asyncio.sleep(0.1)
+    run(test_logged)
+    assert not errors, errors
+
+# idle sessions aren't woken by the server tick, damage wakes them
+def test_idle_sessions_not_woken():
+    async def test():
+        svr = await server(framebuffer=True)
+        reader, writer = await init(svr)
+        writer.write( set_encodings((rfb.RAWRECT,)) )
+        header = await reader.readexactly(4+12)
+        await reader.readexactly(64*48*4)
+        session = svr.sessions[0]
+        updates = []
+        send_damage = session.send_damage
+        session.send_damage = lambda: updates.append(1) or send_damage()
+        await asyncio.sleep(0.1)
+        assert not session.due() and not updates
+        svr.framebuffer.fill_rect(2, 3, 4, 5, (255, 0, 0))
+        header = await reader.readexactly(4+12)
+        assert unpack('>HHHH', header[4:12]) == (2, 3, 4, 5)
+        assert updates
+        writer.close()
+        await svr.shutdown()
+    run(test)
+
+# a cancelled connection task ends cancelled, having closed its session
+def test_cancelled_accept_raised():
+    async def test():
+        svr = await server()
+        reader, writer = await init(svr)
+        writer.write( set_encodings((0,)) )
+        while not svr.sessions:
+            await asyncio.sleep(0.01)
+        task = svr._tasks[0]
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert task.cancelled()
+        assert not svr.sessions and not svr._tasks
+        assert await reader.read(4096) == b''
+        writer.close()
+        await svr.shutdown()
+    run(test)
+
+
+if __name__ == '__main__':
+    test_first_update_in_client_encoding()
+    test_stalled_handshake_closed()
+    test_cancelled_serve_closes_sessions()
+    test_idle_sessions_not_woken()
+    test_cancelled_accept_raised()
+    print('ok')
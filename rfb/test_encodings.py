@@ -0,0 +1,297 @@
+# encodings decoded as a client would, and compared to the pixels
+# encoded, run as a script or with pytest
+import rfb
+from random import getrandbits, seed
+from struct import unpack
+
+# 32 bit little and big endian (ZRLE CPIXELs of 3 bytes), 16 and 8 bit
+formats = (
+    (32, 24, False, True, (255, 255, 255), (16, 8, 0)),
+    (32, 24, True, True, (255, 255, 255), (16, 8, 0)),
+    (16, 16, False, True, (31, 63, 31), (11, 5, 0)),
+    (8, 8, False, True, (7, 7, 3), (0, 3, 6)),
+)
+
+
+# rectangles of class cls at 3,5 of each size, in each pixel format,
+# drawn as: one colour, blocks of one, two and a few colours on
+# another, runs of many colours and noise
+def images(cls, sizes):
+    seed(1)
+    for pf in formats:
+        for w, h in sizes:
+            for colours in (0, 1, 2, 5, 100, None):
+                rect = cls(3, 5, w, h, *pf)
+                rect.fill( colour() )
+                if colours is None:
+                    for y in range(h):
+                        for x in range(w):
+                            rect.setpixel(x, y, colour())
+                elif colours:
+                    palette = [ colour() for i in range(colours) ]
+                    for i in range(w*h//16):
+                        rect.fill_rect(getrandbits(8) % w, getrandbits(8) % h,
+                                       1+getrandbits(4), 1+getrandbits(2),
+                                       palette[getrandbits(8) % colours])
+                yield rect
+
+def colour():
+    return (getrandbits(8), getrandbits(8), getrandbits(8))
+
+# return x, y, w, h, encoding of the rectangle header at b[i:i+12]
+def header(b, i=0):
+    return unpack('>4Hl', b[i:i+12])
+
+# w*h pixels of bytespp, all bg, with w,h sub-rectangles at x,y
+# drawn in order
+def draw(w, h, bytespp, bg, rects):
+    pixels = bytearray(bg*(w*h))
+    for p, x, y, rw, rh in rects:
+        assert x+rw <= w and y+rh <= h
+        for r in range(y, y+rh):
+            pixels[(r*w+x)*bytespp : (r*w+x+rw)*bytespp] = p*rw
+    return bytes(pixels)
+
+# write the tw*th pixels of tile t at tx,ty of pixels, w wide
+def put(pixels, w, bytespp, tx, ty, tw, th, t):
+    n = tw*bytespp
+    for r in range(th):
+        start = ((ty+r)*w+tx)*bytespp
+        pixels[start : start+n] = t[r*n : (r+1)*n]
+
+
+# return the pixels of a Hextile rectangle, and the tile sub-encoding
+# masks seen
+def hextile(b, w, h, bytespp):
+    i = 0
+    pixels = bytearray(w*h*bytespp)
+    masks = set()
+    bg = fg = None
+    for ty in range(0, h, 16):
+        th = min(16, h-ty)
+        for tx in range(0, w, 16):
+            tw = min(16, w-tx)
+            mask = b[i]
+            masks.add(mask)
+            i += 1
+            if mask & rfb.HextileRect.RAW:
+                n = tw*th*bytespp
+                t = b[i:i+n]
+                i += n
+            else:
+                if mask & rfb.HextileRect.BACKGROUND:
+                    bg = b[i:i+bytespp]
+                    i += bytespp
+                if mask & rfb.HextileRect.FOREGROUND:
+                    fg = b[i:i+bytespp]
+                    i += bytespp
+                assert bg is not None
+                rects = []
+                if mask & rfb.HextileRect.ANYSUBRECTS:
+                    n = b[i]
+                    i += 1
+                    for s in range(n):
+                        if mask & rfb.HextileRect.COLOURED:
+                            p = b[i:i+bytespp]
+                            i += bytespp
+                        else:
+                            assert fg is not None
+                            p = fg
+                        xy, wh = b[i], b[i+1]
+                        i += 2
+                        rects.append( (p, xy>>4, xy&15, (wh>>4)+1, (wh&15)+1) )
+                t = draw(tw, th, bytespp, bg, rects)
+            put(pixels, w, bytespp, tx, ty, tw, th, t)
+    assert i == len(b)
+    return bytes(pixels), masks
+
+# every tile sub-encoding is decoded, over tiles cut at the right
+# and bottom edges
+def test_hextile():
+    masks = set()
+    for rect in images(rfb.HextileRect, ((16, 16), (37, 21))):
+        b = rect.to_bytes()
+        assert header(b) == (3, 5, rect.w, rect.h, rfb.HEXTILE)
+        pixels, seen = hextile(b[12:], rect.w, rect.h, rect.bytespp)
+        assert pixels == bytes(rect.buffer)
+        masks |= seen
+    H = rfb.HextileRect
+    assert H.RAW in masks and H.BACKGROUND in masks and 0 in masks
+    assert any( m & H.FOREGROUND for m in masks )
+    assert any( m & H.COLOURED for m in masks )
+    assert any( m & H.ANYSUBRECTS and not m & (H.COLOURED|H.BACKGROUND)
+                for m in masks )
+
+
+# return the pixels of the tiles of a ZRLE rectangle, decompressed,
+# and the tile sub-encodings seen; CPIXELs are the bytes start:stop of
+# pixels of bytespp, the rest zero
+def zrle(b, w, h, bytespp, start, stop):
+    cp = stop-start
+    pad = b'\x00'*start, b'\x00'*(bytespp-stop)
+    def cpixel(i):
+        return pad[0] + b[i:i+cp] + pad[1]
+    def runlength(i):
+        l = 1
+        while b[i] == 255:
+            l += 255
+            i += 1
+        return l + b[i], i+1
+    i = 0
+    pixels = bytearray(w*h*bytespp)
+    subs = set()
+    for ty in range(0, h, 64):
+        th = min(64, h-ty)
+        for tx in range(0, w, 64):
+            tw = min(64, w-tx)
+            sub = b[i]
+            subs.add(sub)
+            i += 1
+            t = []
+            if sub == 0: # raw
+                for p in range(tw*th):
+                    t.append( cpixel(i) )
+                    i += cp
+            elif sub == 1: # solid
+                t = [ cpixel(i) ]*(tw*th)
+                i += cp
+            elif sub <= 16: # packed palette
+                palette = [ cpixel(i+c*cp) for c in range(sub) ]
+                i += sub*cp
+                bits = 1 if sub == 2 else (2 if sub <= 4 else 4)
+                for r in range(th):
+                    row = b[i : i+(tw*bits+7)//8]
+                    i += len(row)
+                    for x in range(tw):
+                        v = row[x*bits//8] >> (8-bits-(x*bits)%8)
+                        t.append( palette[v & ((1<<bits)-1)] )
+            elif sub == 128: # plain RLE
+                while len(t) < tw*th:
+                    p = cpixel(i)
+                    l, i = runlength(i+cp)
+                    t.extend( [p]*l )
+            else: # palette RLE
+                assert sub >= 130
+                palette = [ cpixel(i+c*cp) for c in range(sub-128) ]
+                i += (sub-128)*cp
+                while len(t) < tw*th:
+                    c = b[i]
+                    i += 1
+                    l = 1
+                    if c & 128:
+                        l, i = runlength(i)
+                    t.extend( [palette[c & 127]]*l )
+            assert len(t) == tw*th
+            put(pixels, w, bytespp, tx, ty, tw, th, b''.join(t))
+    assert i == len(b)
+    return bytes(pixels), subs
+
+# every tile sub-encoding is decoded, over tiles cut at the right and
+# bottom edges, from one zlib stream as a session sends them
+def test_zrle():
+    if rfb.zlib is None:
+        return
+    subs = set()
+    zstream = rfb.zlib.compressobj()
+    decompress = rfb.zlib.decompressobj()
+    for rect in images(rfb.ZRLERect, ((64, 64), (100, 70))):
+        rect.zstream = zstream
+        b = rect.to_bytes()
+        assert header(b) == (3, 5, rect.w, rect.h, rfb.ZRLE)
+        n = unpack('>L', b[12:16])[0]
+        assert len(b) == 16+n
+        start, stop = rect.cpixel()
+        if rect.bpp == 32:
+            assert stop-start == 3
+        pixels, seen = zrle(decompress.decompress(b[16:]), rect.w, rect.h,
+                            rect.bytespp, start, stop)
+        assert pixels == bytes(rect.buffer)
+        subs |= seen
+    assert {0, 1, 2, 128} <= subs
+    assert any( 2 < s <= 16 for s in subs )
+    assert any( s > 128 for s in subs )
+
+
+# return the pixels of an RRE (or CoRRE, subrectangles of subrect_size
+# 4) rectangle and the number of subrectangles, the rectangle encoded
+# from b[i:] after its header
+def rre(b, w, h, bytespp, subrect_size, i=12):
+    n = unpack('>L', b[i:i+4])[0]
+    bg = b[i+4 : i+4+bytespp]
+    i += 4+bytespp
+    rects = []
+    for s in range(n):
+        p = b[i:i+bytespp]
+        i += bytespp
+        if subrect_size == 8:
+            x, y, rw, rh = unpack('>4H', b[i:i+8])
+        else:
+            x, y, rw, rh = b[i:i+4]
+        i += subrect_size
+        rects.append( (p, x, y, rw, rh) )
+    assert i == len(b)
+    return draw(w, h, bytespp, bg, rects), n
+
+# decoded, as sent RRE or raw if that is smaller
+def decode_rre(rect):
+    b = rect.to_bytes()
+    x, y, w, h, encoding = header(b)
+    assert (x, y, w, h) == (3, 5, rect.w, rect.h)
+    if encoding == rfb.RAWRECT:
+        return b[12:], None
+    assert encoding == rect.encoding
+    return rre(b, w, h, rect.bytespp, rect.subrect_size)
+
+# the background and subrectangles found cover the pixels exactly
+def test_rre():
+    for cls in (rfb.AutoRRERect, rfb.CoRRERect):
+        raw = subrects = 0
+        for rect in images(cls, ((16, 16), (37, 21), (255, 9))):
+            pixels, n = decode_rre(rect)
+            assert pixels == bytes(rect.buffer)
+            if n is None:
+                raw += 1
+            else:
+                subrects += n
+        assert raw and subrects
+
+# a session without a connection, encoding a framebuffer
+class Viewer(rfb.RfbSession):
+
+    def __init__(self, fb, encodings):
+        self.setup(fb.w, fb.h, b'test')
+        self.encodings = encodings
+        fb.attach(self)
+
+# regions CoRRE can't encode are split to fit, each part is valid
+def test_corre_split():
+    fb = rfb.FrameBuffer(300, 270)
+    seed(2)
+    for i in range(200):
+        fb.fill_rect(getrandbits(9) % 300, getrandbits(9) % 270,
+                     1+getrandbits(5), 1+getrandbits(5), colour())
+    session = Viewer(fb, [rfb.CORRE])
+    rects = session.encode_regions( [(10, 0, 290, 270)] )
+    assert len(rects) > 1
+    area = 0
+    for rect in rects:
+        assert rect.w < 256 and rect.h < 256
+        b = rect.to_bytes()
+        x, y, w, h, encoding = header(b)
+        raw = session.encode(x, y, w, h, rfb.RawRect).to_bytes()[12:]
+        if encoding == rfb.CORRE:
+            b = rre(b, w, h, session.pixelformat.bytespp, 4)[0]
+        else:
+            assert encoding == rfb.RAWRECT
+            b = b[12:]
+        assert b == raw
+        area += w*h
+    assert area == 290*270
+
+
+if __name__ == '__main__':
+    test_hextile()
+    test_zrle()
+    test_rre()
+    test_corre_split()
+    print('ok')
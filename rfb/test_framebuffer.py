@@ -0,0 +1,52 @@
+# FrameBuffer damage published to sessions, run as a script or with pytest
+import rfb
+
+
+# a session without a connection
+class Viewer(rfb.RfbSession):
+    def __init__(self, w, h):
+        self.setup(w, h, b'test')
+
+# a framebuffer of distinct rows, committed, with a session attached
+def framebuffer(w, h):
+    fb = rfb.FrameBuffer(w, h)
+    fb.detect_moves = True
+    for r in range(h):
+        fb.fill_rect(0, r, w, 1, (r, 255-r, r//2))
+    viewer = Viewer(w, h)
+    fb.attach(viewer)
+    fb.commit()
+    viewer.damage.clear()
+    return fb, viewer
+
+
+# a scroll drawn as a blit and a fill of the exposed strip (two damaged
+# regions) is sent as one move, and the strip as damage
+def test_scroll_and_exposed_strip():
+    w, h, dy = 40, 200, 7
+    fb, viewer = framebuffer(w, h)
+    stride = w*3
+    fb.blit(0, 0, w, h-dy, memoryview(fb.buffer)[dy*stride:], stride)
+    fb.fill_rect(0, h-dy, w, dy, (1, 2, 3))
+    assert len(fb.damaged) == 2
+    fb.commit()
+    assert viewer.moves == [ (0, 0, w, h-dy, 0, dy) ]
+    assert viewer.damage.rects == [ (0, h-dy, w, dy) ]
+
+# damaged regions apart are searched for moves on their own
+def test_separate_regions():
+    w, h, dy = 40, 200, 5
+    fb, viewer = framebuffer(w, h)
+    stride = w*3
+    fb.blit(0, 0, w, 60, memoryview(fb.buffer)[dy*stride:], stride)
+    fb.fill_rect(0, 150, w, 10, (1, 2, 3))
+    fb.commit()
+    # rows moved from beyond the region are sent as damage
+    assert viewer.moves == [ (0, 0, w, 60-dy, 0, dy) ]
+    assert sorted(viewer.damage.rects) == [ (0, 60-dy, w, dy), (0, 150, w, 10) ]
+
+
+if __name__ == '__main__':
+    test_scroll_and_exposed_strip()
+    test_separate_regions()
+    print('ok')
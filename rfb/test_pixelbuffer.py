@@ -0,0 +1,70 @@
+# drawing methods of PixelBuffer, run as a script or with pytest
+import rfb
+from rfb.pixelbuffer import PixelBuffer
+
+pf = (32, 24, False, True, (255, 255, 255), (16, 8, 0))
+
+
+# each buffer drawn row by row, and with numpy (if installed)
+def buffers():
+    for threshold in (4096, 1):
+        PixelBuffer.numpy_threshold = threshold
+        yield rfb.FrameBuffer(12, 18)
+        yield rfb.RawRect(0, 0, 12, 18, *pf)
+    PixelBuffer.numpy_threshold = 4096
+
+# a mask, with a background, drawn wholly off the buffer changes nothing
+def test_blit_mask_off_screen():
+    mask = b'\xff'*((8*8+7)//8)
+    for b in buffers():
+        before = bytes(b.buffer)
+        for x, y in ((-8, 0), (-9, 0), (-20, 0), (-20, 5), (12, 0), (0, -8), (0, 18)):
+            b.blit_mask(x, y, 8, 8, mask, (255, 0, 0), (0, 0, 255))
+        assert bytes(b.buffer) == before
+
+# partly off the buffer, only the visible pixels are drawn
+def test_blit_mask_partly_off_screen():
+    mask = b'\xff'*((8*8+7)//8)
+    for b in buffers():
+        n = len(b.buffer)
+        b.blit_mask(-4, -4, 8, 8, mask, (255, 0, 0), (0, 0, 255))
+        assert len(b.buffer) == n
+        assert bytes(b.buffer).count(b.pixel((255, 0, 0))) == 16
+
+# a region blitted from the buffer itself, overlapping, is scrolled
+def test_blit_scroll():
+    for b in buffers():
+        stride = b.w*b.bytespp
+        for w in (b.w, b.w-2): # whole, and part of, rows
+            for dy in (2, -2):
+                for r in range(b.h):
+                    b.fill_rect(0, r, b.w, 1, (r, r, r))
+                src = memoryview(b.buffer)[max(0, -dy)*stride:]
+                b.blit(0, max(0, dy), w, b.h-2, src, stride)
+                rows = [ bytes(b.buffer[r*stride : r*stride+b.bytespp])
+                         for r in range(b.h) ]
+                expected = [ b.pixel((r-dy, r-dy, r-dy))
+                             if 0 <= r-dy < b.h and 0 <= r-max(0, dy) < b.h-2
+                             else b.pixel((r, r, r)) for r in range(b.h) ]
+                assert rows == expected, (w, dy, rows)
+
+# a region blitted from the buffer itself, at another x, is copied from
+# the rows as they were before the blit
+def test_blit_shifted():
+    for b in buffers():
+        stride = b.w*b.bytespp
+        for r in range(b.h):
+            b.fill_rect(0, r, b.w, 1, (r, r, r))
+        b.blit(2, 0, 10, 10, memoryview(b.buffer)[3*stride:], stride)
+        for r in range(10):
+            row = bytes(b.buffer[r*stride : (r+1)*stride])
+            assert row == b.pixel((r, r, r))*2 + b.pixel((r+3, r+3, r+3))*10 \
+                          + b.pixel((r, r, r))*(b.w-12), r
+
+
+if __name__ == '__main__':
+    test_blit_mask_off_screen()
+    test_blit_mask_partly_off_screen()
+    test_blit_scroll()
+    test_blit_shifted()
+    print('ok')
@@ -0,0 +1,94 @@
+# PixelFormat packing of (r,g,b) colours, run as a script or with pytest
+from struct import unpack
+import rfb.pixelformat
+from rfb.pixelformat import PixelFormat, Palette, get_pixelformat, \
+                           default_colours
+
+rgb565 = (16, 16, False, True, (31, 63, 31), (11, 5, 0))
+bgr233 = (8, 8, False, True, (7, 7, 3), (0, 3, 6))
+# the server's default, and red in the most significant byte
+rgb888 = (32, 24, True, True, (255, 255, 255), (16, 8, 0))
+rgbx = (32, 24, True, True, (255, 255, 255), (24, 16, 8))
+colourmap = (8, 8, False, False, (0, 0, 0), (0, 0, 0))
+
+colours = ( (0, 0, 0), (255, 255, 255), (128, 128, 128),
+            (255, 128, 0), (255, 0, 0), (0, 255, 0), (0, 0, 255) )
+
+
+# unpack pixel bytes to (r,g,b), each channel scaled back to 8 bits
+def unpack_pixel(pf, b):
+    fmt = {32: 'L', 16: 'H', 8: 'B'}[pf.bpp]
+    v = unpack(('>' if pf.big else '<') + fmt, b)[0]
+    return tuple( ((v>>shift) & mask)*255//mask
+                  for mask, shift in zip(pf.masks, pf.shifts) )
+
+# known colours survive packing to within a step of each channel
+def round_trip(fmt):
+    pf = PixelFormat(*fmt)
+    for colour in colours:
+        for b in (pf.pack(colour), pf.convert(bytes(colour))):
+            rgb = unpack_pixel(pf, b)
+            for c, v, mask in zip(colour, rgb, pf.masks):
+                assert abs(c-v) <= 255//mask, (fmt, colour, rgb)
+
+def test_rgb565():
+    round_trip(rgb565)
+    pf = PixelFormat(*rgb565)
+    assert unpack('<H', pf.pack((128, 128, 128)))[0] == (15<<11)|(31<<5)|15
+
+def test_bgr233():
+    round_trip(bgr233)
+    pf = PixelFormat(*bgr233)
+    assert pf.pack((255, 128, 0)) == bytes(((3<<3)|7,))
+
+# big-endian only orders the bytes, channels are at their shifts
+def test_big_endian():
+    for fmt in (rgb888, rgbx):
+        round_trip(fmt)
+    assert PixelFormat(*rgb888).pack((255, 1, 2)) == b'\x00\xff\x01\x02'
+    assert PixelFormat(*rgbx).pack((255, 1, 2)) == b'\xff\x01\x02\x00'
+
+# the default palette is built when a colour-map format first needs it
+def test_palette_built_when_needed():
+    palette = PixelFormat.palette
+    PixelFormat.palette = None
+    try:
+        get_pixelformat(*rgb565)
+        assert PixelFormat.palette is None
+        pf = get_pixelformat(*colourmap)
+        assert pf.palette is PixelFormat.palette and len(pf.palette) == 256
+        assert pf.pack((255, 255, 255)) == bytes((215,))
+    finally:
+        PixelFormat.palette = palette
+
+# palette colours are their own index, however given, and pixels
+# converted are as packed, with and without numpy (if installed)
+def test_palette_lookup():
+    numpy = rfb.pixelformat.numpy
+    rgb = bytes( (i*37)&255 for i in range(3*500) )
+    converted = []
+    try:
+        for rfb.pixelformat.numpy in (numpy, None):
+            palette = Palette([ (0,0,0), (255,255,255), (204,0,0), (0,153,51) ])
+            for i, colour in enumerate(palette.colours):
+                assert palette.index(colour) == i
+                assert palette.index(list(colour)) == i
+                assert palette.index(bytes(colour)) == i
+            assert palette.index((250, 10, 10)) == 2
+            pf = PixelFormat(*colourmap, palette=Palette(default_colours()))
+            b = pf.convert(rgb)
+            assert b == b''.join( pf.pack(tuple(rgb[i : i+3]))
+                                  for i in range(0, len(rgb), 3) )
+            converted.append(b)
+    finally:
+        rfb.pixelformat.numpy = numpy
+    assert converted[0] == converted[-1]
+
+
+if __name__ == '__main__':
+    test_rgb565()
+    test_bgr233()
+    test_big_endian()
+    test_palette_built_when_needed()
+    test_palette_lookup()
+    print('ok')
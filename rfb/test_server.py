@@ -0,0 +1,172 @@
+# RfbServer connections, run as a script or with pytest (cpython)
+import rfb
+import socket
+from struct import pack, unpack
+from time import sleep
+
+
+# a server on a free port, driven by service() rather than serve()
+def server(**kwargs):
+    svr = rfb.RfbServer(64, 48, addr=('127.0.0.1', 0), **kwargs)
+    svr.port = svr.s.getsockname()[1]
+    return svr
+
+def service(svr, until, ticks=200):
+    for i in range(ticks):
+        svr.accept()
+        svr.service()
+        if until():
+            return True
+    return False
+
+def read(client, n):
+    b = b''
+    while len(b) < n:
+        r = client.recv(n-len(b))
+        assert r, 'closed by server'
+        b += r
+    return b
+
+def set_encodings(encodings):
+    return pack('>BxH', 2, len(encodings)) \
+           + b''.join( pack('>l', e) for e in encodings )
+
+# connect, returning the client once ServerInit has been received
+def init(svr):
+    client = socket.create_connection(('127.0.0.1', svr.port))
+    client.settimeout(5)
+    service(svr, lambda: svr.handshakes)
+    assert read(client, 12) == b'RFB 003.003\n'
+    client.sendall(b'RFB 003.003\n')
+    service(svr, lambda: False, 5)
+    read(client, 4)
+    client.sendall(b'\x01')
+    service(svr, lambda: False, 5)
+    n = read(client, 24)[-4:]
+    read(client, int.from_bytes(n, 'big'))
+    return client
+
+# connect and complete the handshake, sending encodings
+def connect(svr, encodings=(0,)):
+    sessions = len(svr.sessions)
+    client = init(svr)
+    client.sendall( set_encodings(encodings) )
+    assert service(svr, lambda: len(svr.sessions) > sessions)
+    return client
+
+
+# the socket of a session closed by its client is closed
+def test_disconnect_closes_socket():
+    svr = server()
+    client = connect(svr)
+    session = svr.sessions[0]
+    client.close()
+    assert service(svr, lambda: not svr.sessions)
+    assert session.conn.fileno() == -1
+    svr.s.close()
+
+# shutdown() closes every connection
+def test_shutdown_closes_sockets():
+    svr = server()
+    clients = [ connect(svr) for i in range(2) ]
+    sessions = svr.sessions[:]
+    svr.shutdown()
+    assert not svr.sessions
+    assert all( s.conn.fileno() == -1 for s in sessions )
+    for client in clients:
+        client.close()
+    svr.s.close()
+
+# errors in a session's update() are raised, not swallowed
+class Undeclared(rfb.RfbSession):
+    def update(self):
+        rect = rfb.RRERect(0, 0, 1, 1, (0,0,0), self.bpp, self.depth,
+                           self.big, self.true, self.masks, self.shifts)
+        rect.vector = 3
+
+def test_update_errors_raised():
+    svr = server(handler=Undeclared)
+    client = init(svr)
+    client.sendall( set_encodings((0,)) )
+    try:
+        service(svr, lambda: False)
+        assert False, 'AttributeError not raised'
+    except AttributeError:
+        pass
+    client.close()
+    svr.shutdown()
+    svr.s.close()
+
+# the handshake completes once the client's encodings are received, in
+# however many parts, and the first update is sent in that encoding
+def test_first_update_in_client_encoding():
+    svr = server(framebuffer=True)
+    client = init(svr)
+    # SetPixelFormat (32bpp, as ServerInit), then SetEncodings in parts
+    client.sendall( b'\x00\x00\x00\x00'
+                    + pack('>4B3H3B3x', 32, 24, 1, 1, 255, 255, 255, 16, 8, 0) )
+    service(svr, lambda: False, 5)
+    b = set_encodings( (rfb.HEXTILE, rfb.RAWRECT) )
+    client.sendall(b[:6])
+    service(svr, lambda: False, 5)
+    assert not svr.sessions and svr.handshakes
+    client.sendall(b[6:])
+    assert service(svr, lambda: svr.sessions)
+    header = read(client, 4+12)
+    assert header[0] == 0
+    assert unpack('>l', header[-4:])[0] == rfb.HEXTILE
+    client.close()
+    svr.shutdown()
+    svr.s.close()
+
+# a peer that stalls during the handshake is dropped
+def test_stalled_handshake_dropped():
+    svr = server()
+    timeout_ms = rfb.RfbHandshake.timeout_ms
+    rfb.RfbHandshake.timeout_ms = 100
+    try:
+        client = socket.create_connection(('127.0.0.1', svr.port))
+        client.settimeout(5)
+        service(svr, lambda: svr.handshakes)
+        assert read(client, 12) == b'RFB 003.003\n'
+        sleep(0.15)
+        assert service(svr, lambda: not svr.handshakes, 5)
+        assert client.recv(1) == b''
+    finally:
+        rfb.RfbHandshake.timeout_ms = timeout_ms
+    client.close()
+    svr.s.close()
+
+# a message longer than recv_buffer_max (cut text) closes the session,
+# without the buffer growing to hold it
+def test_long_message_closes_session():
+    svr = server()
+    client = connect(svr)
+    session = svr.sessions[0]
+    client.sendall( pack('>B3xL', 6, 0xffffffff) + bytes(65536) )
+    assert service(svr, lambda: not svr.sessions)
+    assert len(session._msgs) <= session.recv_buffer_size*2
+    assert session.conn.fileno() == -1
+    client.close()
+    svr.s.close()
+
+# an unknown message closes the session, rather than parsing what
+# follows it out of step
+def test_unknown_message_closes_session():
+    svr = server()
+    client = connect(svr)
+    client.sendall( b'\x07' + pack('>BxHHHH', 3, 0, 0, 8, 8) )
+    assert service(svr, lambda: not svr.sessions)
+    client.close()
+    svr.s.close()
+
+
+if __name__ == '__main__':
+    test_disconnect_closes_socket()
+    test_shutdown_closes_sockets()
+    test_update_errors_raised()
+    test_first_update_in_client_encoding()
+    test_stalled_handshake_dropped()
+    test_long_message_closes_session()
+    test_unknown_message_closes_session()
+    print('ok')
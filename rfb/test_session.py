@@ -0,0 +1,81 @@
+# RfbSession frame pacing, run as a script or with pytest (cpython)
+import rfb
+import rfb.session
+from errno import EAGAIN
+from socket import SOL_SOCKET, SO_SNDBUF
+
+
+# a connection carrying rate bytes per second, from a socket buffer of
+# size bytes, on a simulated clock
+class Link():
+
+    def __init__(self, rate, size=65536):
+        self.rate = rate
+        self.size = size
+        self.buffered = 0
+
+    def drain(self, ms):
+        self.buffered = max(0, self.buffered - (self.rate*ms)//1000)
+
+    def sendmsg(self, buffers, ancdata, flags):
+        n = min(sum( len(b) for b in buffers ), self.size-self.buffered)
+        if not n:
+            raise OSError(EAGAIN, 'socket buffer full')
+        self.buffered += n
+        return n
+
+    def getsockopt(self, level, option):
+        assert (level, option) == (SOL_SOCKET, SO_SNDBUF)
+        return self.size
+
+class Viewer(rfb.RfbSession):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.setup(64, 48, b'test')
+
+    def update(self):
+        self.send( bytes(5000) )
+
+# return ms the socket holds when frames are sent, after the first
+# seconds, and the bytes per second sent
+def frames(link, pace=True, seconds=10, tick_ms=20):
+    now = [0]
+    ticks_ms = rfb.session.ticks_ms
+    rfb.session.ticks_ms = lambda: now[0]
+    try:
+        viewer = Viewer(link)
+        if not pace: # throughput never measured
+            viewer.measure_ms = seconds*1000
+        held = []
+        for now[0] in range(0, seconds*1000, tick_ms):
+            link.drain(tick_ms)
+            if viewer.ready():
+                viewer.update()
+                if now[0] >= 5000:
+                    held.append( (link.buffered*1000)//link.rate )
+    finally:
+        rfb.session.ticks_ms = ticks_ms
+    return viewer, sum(held)//len(held), (len(held)*5000)//(seconds-5)
+
+
+# frames for a slow client are paced to its measured throughput, rather
+# than being sent until its socket buffer is full
+def test_paced_to_throughput():
+    viewer, held, rate = frames(Link(30000))
+    assert viewer.throughput == 30000
+    assert rate >= 27000
+    unpaced = frames(Link(30000), pace=False)[1]
+    assert held < unpaced//2, (held, unpaced)
+
+# a client keeping up isn't measured, or paced
+def test_fast_client_not_paced():
+    viewer, held, rate = frames(Link(1000000))
+    assert viewer.throughput is None
+    assert rate == 250000
+
+
+if __name__ == '__main__':
+    test_paced_to_throughput()
+    test_fast_client_not_paced()
+    print('ok')
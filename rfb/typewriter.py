@@ -50,12 +50,12 @@ class TypeWriter(rfb.RfbSession):
         if down:
 
             try:
-                bits = font.getbitmap_str(key)
-                for idx, bit in enumerate(bits):
-                    self.char.setpixel(
-                        idx%font.w, idx//font.w,
-                        (255,255,255) if int(bit) else (0,0,0)
-                    )
+                self.char.blit_mask(
+                    0, 0,
+                    font.w, font.h,
+                    font.getbitmap_bytes(key),
+                    (255,255,255), (0,0,0)
+                )
                 self.rectangles.append( self.char )
                 self.char.x += font.w
             except: